@@ -1,6 +1,14 @@
-from flask import Blueprint, jsonify
+import functools
+
+from flask import Blueprint, Response, jsonify, request
 
 from app.murmur import get_murmur_meta, address_to_ipv6
+from app.broadcast import broadcast, get_template
+from app.cache import preview_cache, texture_cache
+from app.dispatch import get_dispatcher
+from app.outbox import get_outbox
+from app.presence import presence
+from app import fetch, metrics
 from app.util import texture_to_data_uri
 
 api = Blueprint('api', __name__)
@@ -13,64 +21,77 @@ def hello():
 
 @api.route('/servers')
 def servers():
-    meta = get_murmur_meta()
-    servers = []
-    for server in meta.getAllServers():
-        servers.append({
-            'name': server.getConf('registername'),
-            'host': server.getConf('host'),
-            'port': server.getConf('port'),
-            'isRunning': server.isRunning(),
-            'uptime': server.getUptime(),
-            'users': len(server.getUsers())
-        })
+    # ?refresh=1 resyncs with Murmur first rather than trusting the mirror
+    if request.args.get('refresh'):
+        presence.reconcile(get_murmur_meta())
 
     return jsonify({
-        'data': servers
+        'data': presence.servers()
     })
 
 @api.route('/users')
 def users():
-    meta = get_murmur_meta()
     users = []
 
-    for server in meta.getAllServers():
-        for id, user in server.getUsers().items():
-            # Textures are stored as zlib compress()ed 600x60 32-bit BGRA data.
-            # sequence<byte> data
-            texture = ''
-            if user.userid >= 0:
-                texture = server.getTexture(user.userid)
-
-            users.append({
-                'session': user.session,
-                'registered': user.userid >= 0,
-                'mute': user.mute or user.selfMute,
-                'deaf': user.deaf or user.selfDeaf,
-                'channel': user.channel, # ID number
-                'name': user.name,
-                'texture': texture_to_data_uri(texture),
-                'addr': str(address_to_ipv6(user.address))
-            })
-
-            # Not included: onlinesecs, bytespersec,
-            # version, os, osversion, comment, tcponly, idlesecs
+    for server_id, server, user in presence.users():
+        # Textures are stored as zlib compress()ed 600x60 32-bit BGRA data.
+        # sequence<byte> data
+        texture = None
+        if user.userid >= 0:
+            texture = texture_cache.get(
+                server_id,
+                user.userid,
+                functools.partial(load_texture, server, user.userid),
+                texture_to_data_uri
+            )
+
+        users.append({
+            'session': user.session,
+            'registered': user.userid >= 0,
+            'mute': user.mute or user.selfMute,
+            'deaf': user.deaf or user.selfDeaf,
+            'channel': user.channel, # ID number
+            'name': user.name,
+            'texture': texture,
+            'addr': str(address_to_ipv6(user.address))
+        })
+
+        # Not included: onlinesecs, bytespersec,
+        # version, os, osversion, comment, tcponly, idlesecs
 
     return jsonify({
         'data': users
     })
 
-@api.route('/live', methods=['GET', 'POST'])
-def on_live():
-    """Live stream has started. Notify Mumble users"""
-    with open('templates/live_notice.html', 'r') as f:
-        html = f.read()
-
-    meta = get_murmur_meta()
-    for server in meta.getAllServers():
-        server.sendMessageChannel(0, 1, html)
+def load_texture(server, userid: int):
+    with metrics.ice_call('getTexture'):
+        return server.getTexture(userid)
 
-    return ''
+@api.route('/stats')
+def stats():
+    return jsonify({
+        'data': {
+            'dispatcher': get_dispatcher().stats(),
+            'outbox': get_outbox().stats(),
+            'cache': preview_cache.stats(),
+            'hosts': fetch.stats()
+        }
+    })
 
+@api.route('/metrics')
+def metrics_route():
+    return Response(
+        metrics.registry.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
 
+@api.route('/live', methods=['GET', 'POST'])
+def on_live():
+    """Live stream has started. Notify Mumble users"""
+    html = get_template('templates/live_notice.html').render()
 
+    # Always a 200 - nginx-rtmp rejects the stream on anything else, and a
+    # slow or failed server shouldn't stop it going live
+    return jsonify({
+        'data': broadcast(presence.booted(), html)
+    })
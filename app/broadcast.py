@@ -0,0 +1,108 @@
+"""
+    Server-wide notices: cached message templates and a concurrent
+    fan-out of a message to every booted virtual server.
+"""
+import os
+import threading
+import time
+
+from app import metrics
+
+# Seconds a broadcast waits on all servers before reporting the stragglers
+BROADCAST_TIMEOUT = float(os.environ.get('BROADCAST_TIMEOUT', '2'))
+
+
+class Template:
+    """Message loaded from disk once and reused until the file changes
+
+    :param path: Path to the template file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime = None
+        self._html = None
+        self._lock = threading.Lock()
+
+    def render(self) -> str:
+        """Return the template, reloading it only if it changed on disk"""
+        mtime = os.stat(self.path).st_mtime_ns
+
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.path, 'r') as f:
+                    self._html = f.read().strip()
+                self._mtime = mtime
+
+            return self._html
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(path: str) -> Template:
+    """Shared Template instance for a path"""
+    with _templates_lock:
+        template = _templates.get(path)
+        if not template:
+            template = _templates[path] = Template(path)
+
+        return template
+
+
+def broadcast(
+    servers: list,
+    html: str,
+    channel: int = 0,
+    tree: bool = True,
+    timeout: float = BROADCAST_TIMEOUT
+) -> list:
+    """Send a message to a channel on many servers at once
+
+    Every send is put in flight before any is waited on, and the whole
+    broadcast is bounded by `timeout` rather than each server in turn.
+
+    :param servers: List of (server id, Murmur.ServerPrx) tuples
+    :param html: Message to send
+    :param channel: Channel id on each server
+    :param tree: Whether subchannels also receive the message
+    :param timeout: Seconds to wait for all servers to acknowledge
+    :return: Per-server dicts of `server`, `ok`, `ms` and, on failure, `error`
+    """
+    started = time.monotonic()
+    pending = []
+
+    for server_id, server in servers:
+        finished = {}
+        try:
+            future = metrics.ice_future(
+                'sendMessageChannel',
+                server.sendMessageChannelAsync(channel, tree, html)
+            )
+            future.add_done_callback(
+                lambda f, finished=finished: finished.setdefault('at', time.monotonic())
+            )
+        except Exception as e:
+            future = e
+
+        pending.append((server_id, future, finished))
+
+    deadline = started + timeout
+    results = []
+
+    for server_id, future, finished in pending:
+        result = {'server': server_id, 'ok': False}
+
+        try:
+            if isinstance(future, Exception):
+                raise future
+
+            future.result(max(0, deadline - time.monotonic()))
+            result['ok'] = True
+        except Exception as e:
+            result['error'] = type(e).__name__
+
+        result['ms'] = (finished.get('at', time.monotonic()) - started) * 1000
+        results.append(result)
+
+    return results
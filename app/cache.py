@@ -0,0 +1,628 @@
+"""
+    In-memory caches: a bounded one for link preview data (Steam apps and
+    workshop items, page titles, encoded images) and one for encoded
+    Murmur avatar textures.
+"""
+import os
+import hashlib
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from app import deadline, metrics
+from app.diskcache import DiskCache
+
+logger = logging.getLogger('murmur')
+
+# Seconds an entry stays valid, per provider. Prices are the only thing
+# that changes often - titles and thumbnails effectively never do.
+PROVIDER_TTLS = {
+    'steam_app': 15 * 60,
+    'steam_workshop': 60 * 60,
+    'title': 24 * 60 * 60,
+    'image': 24 * 60 * 60
+}
+
+DEFAULT_TTL = 60 * 60
+
+# Seconds past expiry an entry may still be served while a fresh one is
+# loaded in the background (only with a refresher running). Store prices
+# change, but a preview that's a little out of date beats a slow one.
+STALE_TTLS = {
+    'steam_app': 24 * 60 * 60
+}
+
+# Fraction of its TTL left at which a requested entry is refreshed early
+REFRESH_AHEAD = 0.2
+
+# Seconds a failed load (e.g. an invalid app id, or the host being down)
+# is remembered for, so every repost doesn't retry it upstream
+ERROR_TTL = 30
+
+
+def sizeof(value) -> int:
+    """Rough recursive estimate of the memory held by a cached value
+
+    :param value: Value to measure. Containers are walked, anything else
+                  is measured with `sys.getsizeof`
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sizeof(k) + sizeof(v)
+    elif isinstance(value, (list, tuple, set)):
+        for v in value:
+            size += sizeof(v)
+
+    return size
+
+
+def recreate(kind: type, args: tuple) -> Exception:
+    """A new exception equal to one raised earlier, for a remembered failure
+
+    :param kind: Exception class that was raised
+    :param args: Its `args`
+    """
+    try:
+        return kind(*args)
+    except Exception:
+        # Some exceptions take more than their args to construct
+        return RuntimeError('{}: {}'.format(kind.__name__, ', '.join(map(str, args))))
+
+
+class Flight:
+    """A load in progress that other callers can wait on
+
+    A failure is kept as the (type, args) of the exception, so that each
+    waiter raises one of its own (see `recreate`).
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Entry:
+    """A cached value, and how to reload it for a background refresh"""
+    __slots__ = ('stored', 'expires', 'stale_until', 'size', 'value', 'accessed', 'loader', 'ttl')
+
+    def __init__(self, stored, expires, stale_until, size, value, accessed):
+        self.stored = stored
+        self.expires = expires
+        self.stale_until = stale_until
+        self.size = size
+        self.value = value
+        self.accessed = accessed
+        self.loader = None
+        self.ttl = None
+
+
+class PreviewCache:
+    """Thread-safe TTL + LRU cache keyed by (provider, id)
+
+    Entries expire after their provider's TTL and the least recently used
+    entries are evicted once the estimated size of all cached values would
+    exceed `max_bytes`.
+
+    Concurrent `get_or_load` misses for the same key share a single call
+    to the loader rather than each fetching upstream.
+
+    With a `disk` tier, every value set is also written through to disk,
+    and memory misses are looked up there (and promoted back into memory)
+    before counting as a miss.
+
+    Failed loads are remembered for `error_ttl` seconds, during which
+    `get_or_load` raises a fresh copy of the exception (same type and
+    arguments) without calling the loader.
+
+    With a `refresher` (see `app.refresh.Refresher`), providers listed in
+    `stale_ttls` are served stale-while-revalidate: `get_or_load` returns
+    an expired value straight away - for up to that many seconds past
+    expiry - and leaves loading a fresh one to the refresher. Entries with
+    less than `refresh_ahead` of their TTL left are refreshed the same way
+    before they expire at all.
+
+    :param max_bytes: Memory budget for cached values
+    :param ttls: Seconds each provider's entries stay valid
+    :param clock: Monotonic time source (overridable for testing)
+    :param disk: Optional `app.diskcache.DiskCache` second tier
+    :param stale_ttls: Seconds past expiry each provider's entries may still be served
+    :param refresh_ahead: Fraction of an entry's TTL left when it's due for a refresh
+    :param error_ttl: Seconds a failed load is remembered for. 0 to disable
+    """
+    def __init__(
+        self,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttls: dict = None,
+        clock: callable = time.monotonic,
+        disk: DiskCache = None,
+        stale_ttls: dict = None,
+        refresh_ahead: float = REFRESH_AHEAD,
+        error_ttl: float = ERROR_TTL
+    ):
+        self.max_bytes = max_bytes
+        self.ttls = ttls if ttls is not None else PROVIDER_TTLS
+        self.clock = clock
+        self.disk = disk
+        self.stale_ttls = stale_ttls if stale_ttls is not None else STALE_TTLS
+        self.refresh_ahead = refresh_ahead
+        self.error_ttl = error_ttl
+        self.refresher = None
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._errors = {}
+        self._hits = {}
+        self._disk_hits = {}
+        self._stale_hits = {}
+        self._misses = {}
+        self._shared = {}
+        self._error_hits = {}
+
+    def get(self, provider: str, id: str, default=None):
+        """Return a cached value, or `default` if missing or expired
+
+        :param provider: Namespace of the id (e.g. `steam_app`)
+        :param id: Identifier within the provider
+        """
+        entry = self._lookup(provider, id, stale=False)
+        return entry.value if entry else default
+
+    def _lookup(self, provider, id, stale):
+        """Find an entry in memory, then on disk
+
+        :param stale: Also return an expired entry still within its
+                      provider's stale TTL
+        :return: The Entry, or None on a miss
+        """
+        key = (provider, id)
+        now = self.clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.stale_until < now:
+                self._remove(key)
+                entry = None
+
+            if entry and (stale or entry.expires >= now):
+                entry.accessed = now
+                self._entries.move_to_end(key)
+                self._count(self._hits if entry.expires >= now else self._stale_hits, provider)
+                return entry
+
+        found = self._disk_get(provider, id)
+
+        with self._lock:
+            if found and (stale or found[1] > 0):
+                self._count(self._disk_hits if found[1] > 0 else self._stale_hits, provider)
+                return self._store(key, found[0], found[1])
+
+            self._count(self._misses, provider)
+            return None
+
+    @staticmethod
+    def _count(counter, provider):
+        counter[provider] = counter.get(provider, 0) + 1
+
+    def set(self, provider: str, id: str, value, ttl: float = None):
+        """Cache a value, evicting least recently used entries to fit
+
+        Values larger than the whole budget are not cached.
+
+        :param provider: Namespace of the id (e.g. `steam_app`)
+        :param id: Identifier within the provider
+        :param value: Value to cache. Should be treated as read-only
+        :param ttl: Seconds to keep the value. Defaults to the provider's TTL
+        """
+        self._set(provider, id, value, ttl)
+
+    def _set(self, provider, id, value, ttl, loader=None, loader_ttl=None):
+        if ttl is None:
+            ttl = self.ttls.get(provider, DEFAULT_TTL)
+
+        with self._lock:
+            self._errors.pop((provider, id), None)
+            entry = self._store((provider, id), value, ttl)
+            if entry:
+                entry.loader = loader
+                entry.ttl = loader_ttl
+
+        if self.disk:
+            try:
+                self.disk.set(provider, id, value, ttl)
+            except (sqlite3.Error, TypeError, ValueError):
+                logger.exception('Failed to write %s %s to the disk cache', provider, id)
+
+    def _store(self, key, value, ttl):
+        """Put a value in memory, evicting least recently used entries to fit
+
+        :param ttl: Seconds until it expires. Negative if it already has
+        :return: The new Entry, or None if the value was too large to cache
+        """
+        size = sizeof(value)
+        now = self.clock()
+
+        if key in self._entries:
+            self._remove(key)
+
+        if size > self.max_bytes:
+            return None
+
+        while self._bytes + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+        entry = self._entries[key] = Entry(
+            now,
+            now + ttl,
+            now + ttl + self.stale_ttls.get(key[0], 0),
+            size,
+            value,
+            now
+        )
+        self._bytes += size
+        return entry
+
+    def _disk_get(self, provider, id):
+        if not self.disk:
+            return None
+
+        try:
+            return self.disk.get(provider, id, self.stale_ttls.get(provider, 0))
+        except (sqlite3.Error, ValueError):
+            logger.exception('Failed to read %s %s from the disk cache', provider, id)
+            return None
+
+    def get_or_load(self, provider: str, id: str, loader: callable, ttl=None):
+        """Return a cached value, calling `loader()` to fill it on a miss
+
+        If the same key is already being loaded by another thread, this
+        waits for and returns that result instead of calling `loader`.
+        Exceptions raised by the loader propagate (anew to every waiter)
+        and are raised again for `error_ttl` seconds without reloading. A
+        waiter with time left doesn't inherit a load's `DeadlineExceeded`
+        but loads again itself.
+
+        Stale and nearly expired entries of providers in `stale_ttls` are
+        returned as they are and queued with the refresher to be reloaded.
+
+        :param provider: Namespace of the id (e.g. `steam_app`)
+        :param id: Identifier within the provider
+        :param loader: Callable returning the value to cache
+        :param ttl: Seconds to keep the loaded value, or a callable given the
+                    value that returns them. Defaults to the provider's TTL
+        """
+        revalidate = self.refresher is not None and provider in self.stale_ttls
+
+        entry = self._lookup(provider, id, stale=revalidate)
+        if entry is None:
+            return self._load(provider, id, loader, ttl)
+
+        if revalidate:
+            with self._lock:
+                # Remember how to reload it, since a disk hit can't know
+                entry.loader = loader
+                entry.ttl = ttl
+                due = self._due(entry, entry.accessed)
+
+            if due:
+                self.refresher.schedule(provider, id, entry.accessed)
+
+        return entry.value
+
+    def _due(self, entry, now) -> bool:
+        """Whether an entry has less than `refresh_ahead` of its own TTL left
+
+        Entries read back from disk count their TTL from then, since only
+        the expiry time is kept there.
+        """
+        return entry.expires - now < (entry.expires - entry.stored) * self.refresh_ahead
+
+    def _load(self, provider, id, loader, ttl, force=False):
+        """Call `loader` and cache its result, sharing it with concurrent callers
+
+        :param force: Reload even if a fresh entry is already cached
+        """
+        key = (provider, id)
+
+        with self._lock:
+            failed = self._errors.get(key)
+            if failed and not force:
+                if failed[0] >= self.clock():
+                    self._count(self._error_hits, provider)
+                    raise recreate(failed[1], failed[2]) from None
+
+                del self._errors[key]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+
+            if leader:
+                # Another load may have finished since the miss above
+                entry = self._entries.get(key)
+                if not force and entry and entry.expires >= self.clock():
+                    return entry.value
+
+                flight = self._inflight[key] = Flight()
+            else:
+                self._count(self._shared, provider)
+
+        if not leader:
+            # The load may be someone else's, without (or with a later) deadline
+            left = deadline.remaining()
+            if not flight.done.wait(None if left is None else max(0, left)):
+                raise deadline.DeadlineExceeded('Gave up waiting on {} {}'.format(provider, id))
+
+            if flight.error:
+                kind, args = flight.error
+
+                # The leader ran out of its own time, which may not be ours
+                if issubclass(kind, deadline.DeadlineExceeded):
+                    left = deadline.remaining()
+                    if left is None or left > 0:
+                        return self._load(provider, id, loader, ttl, force)
+
+                raise recreate(kind, args) from None
+
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self._set(
+                provider,
+                id,
+                flight.value,
+                ttl(flight.value) if callable(ttl) else ttl,
+                loader,
+                ttl
+            )
+        except Exception as e:
+            # Only the type and arguments are kept, so neither waiters nor
+            # the negative cache hold on to the failed load's frames
+            flight.error = (type(e), e.args)
+            raise
+        finally:
+            with self._lock:
+                # Running out of time is down to the caller, not the key
+                if flight.error and self.error_ttl \
+                        and not issubclass(flight.error[0], deadline.DeadlineExceeded):
+                    self._errors[key] = (self.clock() + self.error_ttl,) + flight.error
+                del self._inflight[key]
+            flight.done.set()
+
+        return flight.value
+
+    def refresh(self, provider: str, id: str) -> bool:
+        """Reload an entry with the loader that last filled it
+
+        On failure the current (possibly stale) value is kept.
+
+        :return: False if the entry is gone or has no loader to refresh with
+        """
+        with self._lock:
+            entry = self._entries.get((provider, id))
+            if not entry or not entry.loader:
+                return False
+
+            loader = entry.loader
+            ttl = entry.ttl
+
+        self._load(provider, id, loader, ttl, force=True)
+        return True
+
+    def refresh_candidates(self, recent: float) -> list:
+        """Entries worth refreshing before anyone asks for them again
+
+        :param recent: Only entries requested within this many seconds
+        :return: List of (last requested, provider, id) of entries that are
+                 stale or due for a refresh, most recently requested first
+        """
+        now = self.clock()
+
+        with self._lock:
+            candidates = [
+                (entry.accessed, provider, id)
+                for (provider, id), entry in self._entries.items()
+                if provider in self.stale_ttls
+                and entry.loader
+                and now - entry.accessed <= recent
+                and self._due(entry, now)
+            ]
+
+        candidates.sort(reverse=True)
+        return candidates
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self):
+        """Drop all entries, including those on disk (counters are kept)"""
+        with self._lock:
+            self._entries.clear()
+            self._errors.clear()
+            self._bytes = 0
+
+        if self.disk:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        """Snapshot of cache size and per-provider hit/miss counters"""
+        with self._lock:
+            providers = {}
+            for provider in set(self._hits) | set(self._disk_hits) | set(self._stale_hits) | set(self._misses):
+                hits = self._hits.get(provider, 0)
+                disk_hits = self._disk_hits.get(provider, 0)
+                stale_hits = self._stale_hits.get(provider, 0)
+                misses = self._misses.get(provider, 0)
+                providers[provider] = {
+                    'hits': hits,
+                    'disk_hits': disk_hits,
+                    'stale_hits': stale_hits,
+                    'misses': misses,
+                    'shared': self._shared.get(provider, 0),
+                    'errors': self._error_hits.get(provider, 0),
+                    'hit_rate': (hits + disk_hits + stale_hits) / (hits + disk_hits + stale_hits + misses)
+                }
+
+            stats = {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'providers': providers
+            }
+
+        if self.disk:
+            stats['disk'] = self.disk.stats()
+
+        if self.refresher:
+            stats['refresh'] = self.refresher.stats()
+
+        return stats
+
+
+def create_disk_cache():
+    """Disk tier configured by `PREVIEW_DISK_CACHE` (a path, or empty to disable)
+
+    Only the running bot should open this - see `app.main`. Anything else
+    importing the cache (tests, benchmarks) gets the memory tier alone.
+    """
+    path = os.environ.get(
+        'PREVIEW_DISK_CACHE',
+        os.path.join(os.path.dirname(__file__), '..', '.preview_cache.sqlite3')
+    )
+    if not path:
+        return None
+
+    try:
+        return DiskCache(
+            path,
+            max_bytes=int(os.environ.get('PREVIEW_DISK_CACHE_BYTES', 256 * 1024 * 1024)),
+            grace=max(STALE_TTLS.values(), default=0)
+        )
+    except sqlite3.Error:
+        logger.exception('Preview disk cache unavailable, caching in memory only')
+        return None
+
+
+# Memory only until `app.main` attaches the disk tier
+preview_cache = PreviewCache(
+    max_bytes=int(os.environ.get('PREVIEW_CACHE_BYTES', 32 * 1024 * 1024))
+)
+
+
+@metrics.registry.collector
+def _collect():
+    stats = preview_cache.stats()
+    providers = stats['providers']
+
+    return [
+        ('sybot_cache_hits_total', 'counter', 'Preview cache hits', [
+            ({'provider': p}, s['hits']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_disk_hits_total', 'counter', 'Preview cache misses served from disk', [
+            ({'provider': p}, s['disk_hits']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_stale_hits_total', 'counter', 'Preview cache hits served stale while refreshed', [
+            ({'provider': p}, s['stale_hits']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_misses_total', 'counter', 'Preview cache misses', [
+            ({'provider': p}, s['misses']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_shared_loads_total', 'counter', 'Preview cache misses that waited on a load already in flight', [
+            ({'provider': p}, s['shared']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_error_hits_total', 'counter', 'Preview cache loads failed fast with a remembered error', [
+            ({'provider': p}, s['errors']) for p, s in providers.items()
+        ]),
+        ('sybot_cache_bytes', 'gauge', 'Estimated memory held by the preview cache', [
+            ({}, stats['bytes'])
+        ])
+    ]
+
+
+class TextureCache:
+    """Encoded avatar thumbnails of registered users
+
+    Keyed by (server id, userid). An entry is reused without asking Murmur
+    for the texture at all until it's invalidated (the user's state changed).
+    After that the texture is fetched again, but only re-encoded if its
+    hash differs from what was cached. Entries are dropped once the user
+    leaves or the server stops.
+    """
+    def __init__(self):
+        # key -> (digest, encoded, generation it was loaded at)
+        self._entries = {}
+
+        # key -> invalidations so far, for every key cached or being loaded.
+        # An invalidation while a load is in flight leaves what it loaded
+        # stale, since it may predate the change.
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, server_id: int, userid: int, load: callable, encode: callable) -> str:
+        """Return the encoded texture for a user
+
+        :param server_id: Murmur virtual server id
+        :param userid: Registered user id
+        :param load: Callable returning the raw texture (e.g. `server.getTexture`)
+        :param encode: Callable turning a raw texture into its encoded form
+        """
+        key = (server_id, userid)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generations.setdefault(key, 0)
+            if entry and entry[2] == generation:
+                return entry[1]
+
+        texture = load()
+        digest = hashlib.sha1(texture).digest()
+
+        if entry and entry[0] == digest:
+            encoded = entry[1]
+        else:
+            encoded = encode(texture)
+
+        with self._lock:
+            # Unless the user left meanwhile, or a newer load got there first
+            current = self._entries.get(key)
+            if key in self._generations and (not current or current[2] <= generation):
+                self._entries[key] = (digest, encoded, generation)
+
+        return encoded
+
+    def invalidate(self, server_id: int, userid: int):
+        """Recheck a user's texture the next time it's requested"""
+        with self._lock:
+            key = (server_id, userid)
+            if key in self._generations:
+                self._generations[key] += 1
+
+    def invalidate_server(self, server_id: int):
+        """Recheck all textures on a server (e.g. it was restarted)"""
+        with self._lock:
+            for key in self._generations:
+                if key[0] == server_id:
+                    self._generations[key] += 1
+
+    def remove(self, server_id: int, userid: int):
+        """Forget a user's texture (e.g. they disconnected)"""
+        with self._lock:
+            self._entries.pop((server_id, userid), None)
+            self._generations.pop((server_id, userid), None)
+
+    def remove_server(self, server_id: int):
+        """Forget every texture on a server (e.g. it stopped or was deleted)"""
+        with self._lock:
+            for key in [key for key in self._generations if key[0] == server_id]:
+                self._entries.pop(key, None)
+                del self._generations[key]
+
+
+texture_cache = TextureCache()
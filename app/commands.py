@@ -1,15 +1,29 @@
 
+import os
 import re
+import logging
 import functools
+import importlib
 import random
-import requests
+import time
+from concurrent.futures import TimeoutError
+from contextvars import copy_context
 
-import Murmur
+from app import deadline, metrics
+from app.dispatch import INTERACTIVE, IO, get_preview_executor
+from app.router import Router
+from app.slice import Murmur
 
-from app.steam import SteamApp, SteamWorkshopItem
-from app.util import get_url_title, image_url_to_data_uri, strip_html
+logger = logging.getLogger('murmur')
 
-command_subscribers = []
+router = Router()
+
+# All subscribed commands, in registration order
+command_subscribers = router.commands
+
+# Comma separated handler names to enable (e.g. `roll,pick_one,youtube`).
+# All commands are enabled if unset.
+ENABLED_COMMANDS = set(filter(None, os.environ.get('COMMANDS', '').split(',')))
 
 class TextMessage(Murmur.TextMessage):
     """Wrapper for Murmur TextMessages to add additional message context
@@ -21,6 +35,11 @@ class TextMessage(Murmur.TextMessage):
     :param trees: Trees of channels who were sent this message.
     :param text: The contents of the message.
     :param match: Re match groups if the message was mapped to a command
+    :param outbox: `app.outbox.Outbox` replies are queued on. If None,
+                   replies are sent immediately
+    :param lane: Dispatcher lane of the command handling this message.
+                 Replies from the interactive lane skip the outbox's
+                 coalescing window and preview rate limit
     """
     def __init__(
         self,
@@ -30,12 +49,33 @@ class TextMessage(Murmur.TextMessage):
         channels=None,
         trees=None,
         text='',
-        match=None
+        match=None,
+        outbox=None,
+        lane=INTERACTIVE
     ):
         super().__init__(sessions, channels, trees, text)
         self.user = user
         self.server = server
         self.match = match
+        self.outbox = outbox
+        self.lane = lane
+
+    def with_match(self, match):
+        """Copy of this message bound to a different command match
+
+        :param match: Re match of the command being run
+        """
+        return TextMessage(
+            self.user,
+            self.server,
+            self.sessions,
+            self.channels,
+            self.trees,
+            self.text,
+            match,
+            self.outbox,
+            self.lane
+        )
 
 class TextResponse:
     """Prepared message to an individual, channel, or server
@@ -71,17 +111,28 @@ class TextResponse:
     #     for server in servers:
 
 
+@metrics.publish_seconds.time()
 def publish(
     server: Murmur.Server,
     user: Murmur.User,
-    msg: Murmur.TextMessage
+    msg: Murmur.TextMessage,
+    dispatcher=None,
+    outbox=None
 ):
     """Publish a text message to all commands matching the message pattern
 
     :param server: Originating server instance
     :param user: User that sent the message
     :param msg: The message that was sent
+    :param dispatcher: Optional `app.dispatch.Dispatcher` to run the matched
+                       command on. If omitted, the command runs inline.
+    :param outbox: Optional `app.outbox.Outbox` to queue replies on. If
+                   omitted, replies are sent immediately.
     """
+    command, match = router.match(msg.text)
+    if not command:
+        return
+
     # Wrap original message in a more context aware TextMessage
     wrapped = TextMessage(
         user,
@@ -89,38 +140,235 @@ def publish(
         msg.sessions,
         msg.channels,
         msg.trees,
-        msg.text
+        msg.text,
+        outbox=outbox,
+        lane=command['lane']
     )
 
-    for command in command_subscribers:
-        match = command['prog'].search(msg.text)
-        if match:
-            command['func'](wrapped, **match.groupdict())
-            return
+    if command['preview']:
+        # Every link in the message gets previewed, not just the first
+        previews = collect_previews(wrapped)
+        name = '+'.join(sorted(set(c['func'].__name__ for c, _ in previews)))
+        budgets = [c['budget'] for c, _ in previews]
+        budget = None if None in budgets else max(budgets)
+        func = send_previews
+        args = (wrapped, previews)
+        kwargs = {}
+    else:
+        name = command['func'].__name__
+        budget = command['budget']
+        func = command['func']
+        args = (wrapped.with_match(match),)
+        kwargs = match.groupdict()
+
+    # The budget starts now, so time spent queued for a worker counts
+    if budget is not None:
+        args = (time.monotonic() + budget, func) + args
+        func = deadline.call_with_deadline
+
+    if dispatcher:
+        dispatcher.submit(name, func, *args, lane=command['lane'], **kwargs)
+    else:
+        func(*args, **kwargs)
+
+
+def collect_previews(msg: TextMessage) -> list:
+    """Find every preview command match in a message
+
+    The same link often appears more than once (e.g. in both the href and
+    the text of an anchor) so matches are de-duplicated by command and
+    captured groups.
+
+    :param msg: TextMessage to search
+    :return: List of (command, re.Match) tuples
+    """
+    previews = []
+    seen = set()
+
+    for command, match in router.match_all(msg.text):
+        if not command['preview']:
+            continue
+
+        key = (command['func'], tuple(sorted(match.groupdict().items())))
+        if key not in seen:
+            seen.add(key)
+            previews.append((command, match))
+
+    return previews
+
+
+def send_previews(msg: TextMessage, previews: list):
+    """Resolve link previews concurrently and reply with one merged message
+
+    Previews still unresolved when the deadline passes are left out of
+    the reply rather than holding up the rest.
+
+    :param msg: TextMessage that contained the links
+    :param previews: (command, re.Match) tuples from `collect_previews`
+    """
+    def resolve(command, match):
+        with metrics.preview_seconds.time(command['func'].__name__):
+            return command['func'](msg.with_match(match), **match.groupdict())
+
+    # Skip the hop through the pool for the common single link case
+    if len(previews) == 1:
+        calls = [lambda: resolve(*previews[0])]
+    else:
+        executor = get_preview_executor()
+        futures = [executor.submit(copy_context().run, resolve, c, m) for c, m in previews]
+        calls = [functools.partial(wait_for, f) for f in futures]
+
+    fragments = []
+    for (command, _), call in zip(previews, calls):
+        try:
+            fragment = call()
+        except (TimeoutError, deadline.DeadlineExceeded):
+            logger.warning('Preview %s missed its deadline', command['func'].__name__)
+            continue
+        except Exception:
+            logger.exception('Preview %s failed', command['func'].__name__)
+            continue
+
+        if fragment:
+            fragments.append(fragment)
+
+    if fragments:
+        reply(msg, '<br/><br/>'.join(fragments))
+
+
+def wait_for(future):
+    """Result of a future, waiting no longer than the current deadline"""
+    left = deadline.remaining()
+    return future.result(None if left is None else max(0, left))
+
+
+def reply(msg: TextMessage, text: str):
+    """Reply to the same channel(s) the message was sent to
+
+    :param msg: TextMessage being replied to
+    :param text: Text or HTML to send
+    """
+    for channel in msg.channels:
+        if msg.outbox:
+            msg.outbox.send(msg.server, channel, text, urgent=msg.lane == INTERACTIVE)
+        else:
+            msg.server.sendMessageChannel(channel, False, text)
 
 
 def subscribe(
     pattern: str,
     usage: str,
-    func: callable
+    func: callable,
+    prefix: tuple = None,
+    keywords: tuple = None,
+    preview: bool = False,
+    budget: float = None,
+    lane: str = INTERACTIVE
 ):
+    """Register a command to be run for messages matching `pattern`
+
+    :param pattern: Regex searched (case-insensitive) against the message
+    :param usage: Help text listed by `!help`. None for implicit commands
+    :param func: Handler called with the TextMessage and named match groups
+    :param prefix: Literal strings the message must start with for
+                   `pattern` to be tried. See `app.router.Router`
+    :param keywords: Literal substrings the message must contain for
+                     `pattern` to be tried. See `app.router.Router`
+    :param preview: Link preview commands return an HTML fragment instead
+                    of replying. Every preview match in a message is
+                    resolved concurrently and merged into a single reply.
+    :param budget: Seconds the command has to reply, counted from when the
+                   message arrived. Fetches are cut short to fit and the
+                   handler should reply with whatever it has by then.
+                   See `app.deadline`. None for no limit
+    :param lane: Dispatcher lane to run on. `app.dispatch.INTERACTIVE`
+                 for commands that only use the CPU and reply straight
+                 away, `app.dispatch.IO` for anything that waits on the
+                 network. A preview message runs on the lane of its
+                 first link.
+    """
+    if ENABLED_COMMANDS and func.__name__ not in ENABLED_COMMANDS:
+        return
+
     # Make sure it's not already registered before registering
     # (can happen during werkzeug lazy reloads)
     for command in command_subscribers:
         if command['func'] == func:
             return
 
-    command_subscribers.append({
+    router.add({
         'prog': re.compile(pattern, re.IGNORECASE),
         'usage': usage,
-        'func': func
+        'func': func,
+        'prefix': prefix,
+        'keywords': keywords,
+        'preview': preview,
+        'budget': budget,
+        'lane': lane
     })
 
 
-def command(pattern: str, usage: str = None):
-    """Decorator for command subscriber methods"""
+class LazyHandler:
+    """Command handler that is imported from its plugin module on first call
+
+    :param target: `module:function` path of the handler
+    """
+    def __init__(self, target: str):
+        self.target = target
+        self.module, _, self.__name__ = target.partition(':')
+        self._func = None
+
+    def resolve(self) -> callable:
+        """Import (once) and return the real handler"""
+        if self._func is None:
+            self._func = getattr(importlib.import_module(self.module), self.__name__)
+
+        return self._func
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __eq__(self, other):
+        return isinstance(other, LazyHandler) and other.target == self.target
+
+    def __hash__(self):
+        return hash(self.target)
+
+
+def lazy_command(
+    target: str,
+    pattern: str,
+    usage: str = None,
+    prefix: tuple = None,
+    keywords: tuple = None,
+    preview: bool = False,
+    budget: float = None,
+    lane: str = IO
+):
+    """Register a command implemented in a module that isn't imported yet
+
+    Only the pattern is compiled now. The module (and whatever heavy
+    dependencies it pulls in) is imported the first time a message
+    matches. These are the slow commands, so they run on the I/O lane
+    unless told otherwise. See `subscribe` for the other arguments.
+
+    :param target: `module:function` path of the handler
+    """
+    subscribe(pattern, usage, LazyHandler(target), prefix, keywords, preview, budget, lane)
+
+
+def command(
+    pattern: str,
+    usage: str = None,
+    prefix: tuple = None,
+    keywords: tuple = None,
+    preview: bool = False,
+    budget: float = None,
+    lane: str = INTERACTIVE
+):
+    """Decorator for command subscriber methods. See `subscribe`"""
     def decorator(func):
-        subscribe(pattern, usage, func)
+        subscribe(pattern, usage, func, prefix, keywords, preview, budget, lane)
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -129,7 +377,7 @@ def command(pattern: str, usage: str = None):
     return decorator
 
 
-@command('^(hi|hello)$')
+@command('^(hi|hello)$', prefix=('hi', 'hello'), lane=INTERACTIVE)
 def hello(msg: TextMessage):
     """Test command to ensure the bot is running properly
 
@@ -146,11 +394,10 @@ def hello(msg: TextMessage):
     text = random.choice(phrases)
 
     # Reply to the same channel(s) the message was sent to
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, text)
+    reply(msg, text)
 
 
-@command('^!h(e|a)lp', usage='!help - Prints this help message')
+@command('^!h(e|a)lp', usage='!help - Prints this help message', prefix=('!',), lane=INTERACTIVE)
 def usage(msg: TextMessage):
     """List commands available for the user
 
@@ -170,7 +417,12 @@ def usage(msg: TextMessage):
     msg.server.sendMessage(msg.user.session, html)
 
 
-@command('^!pickone', usage='!pickone - Select one item from a list at random. Eg: !pickone Gfro, Phantom, Mark')
+@command(
+    '^!pickone',
+    usage='!pickone - Select one item from a list at random. Eg: !pickone Gfro, Phantom, Mark',
+    prefix=('!',),
+    lane=INTERACTIVE
+)
 def pick_one(msg: TextMessage):
     """Select an item from a user provided list at random
 
@@ -188,11 +440,15 @@ def pick_one(msg: TextMessage):
     text = random.choice(phrases).format(choice)
 
     # Reply to the same channel(s) the message was sent to
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, text)
+    reply(msg, text)
 
 
-@command('^!(?P<dice>\d+)d(?P<sides>\d+)', usage='!#d# - Roll dice. Eg: !2d6 will roll 2 six-sided dice')
+@command(
+    r'^!(?P<dice>\d+)d(?P<sides>\d+)',
+    usage='!#d# - Roll dice. Eg: !2d6 will roll 2 six-sided dice',
+    prefix=('!',),
+    lane=INTERACTIVE
+)
 def roll(msg: TextMessage, dice: str, sides: str):
     """Dice roller for an arbitrary number of dice and sides
 
@@ -213,151 +469,61 @@ def roll(msg: TextMessage, dice: str, sides: str):
         rolls = [str(random.randint(1, sides)) for x in range(dice)]
         text = '{} rolled {}'.format(msg.user.name, ', '.join(rolls))
 
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, text)
-
-
-@command(r'(?:youtube(?:-nocookie)?\.com/(?:[^/]+/.+/|(?:v|e(?:mbed)?)/|.*[?&]v=)|youtu\.be/)(?P<id>[^\"&?/ ]{11})')
-def youtube(msg: TextMessage, id: str):
-    """YouTube links display the title of the video linked.
-
-    Regex sourced from https://stackoverflow.com/a/6382259
-
-    :param msg: TextMessage that triggered this command response
-    :param id: YouTube video ID
-    """
-    page_url = 'https://www.youtube.com/watch?v={}'
-    thumbnail_url = 'https://img.youtube.com/vi/{}/mqdefault.jpg'
-
-    # Other options:
-    # https://img.youtube.com/vi/I_nkflrpp90/default.jpg - 120x90
-    # https://img.youtube.com/vi/I_nkflrpp90/mqdefault.jpg - 320x180
-    # https://img.youtube.com/vi/I_nkflrpp90/hqdefault.jpg - 480x360
-
-    title = get_url_title(page_url.format(id))
-    thumbnail = image_url_to_data_uri(thumbnail_url.format(id))
-    # thumbnail = None
-
-    # Extract the original youtube URL from the message.
-    # We don't want whatever else is in their message, just the full
-    # url associated with the ID. This is to make a large clickable
-    # link that maintains whatever other context they posted with the
-    # url (timestamp, playlist, etc)
-    # original_url = re.search('[^\s"\']+' + re.escape(id) + '[^\s"\']+', msg.text).group()
-
-    original_url = strip_html(msg.text)
-
-    # List who posted it, the title, and a linked thumbnail
-    html = '{} posted a link to <b>{}</b><br/><a href="{}"><img src="{}"/></a>'.format(
-        msg.user.name,
-        title[:-10], # Title without the ` - YouTube` suffix
-        original_url,
-        thumbnail
-    )
-
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, html)
-
-
-@command('https?://(?:www\.)?veoh.com/watch/yapi-(?P<id>[^\s]+)\"')
-def veoh(msg: TextMessage, id: str):
-    """Handle YouTube links that are just rehosted on Veoh
-
-    This method simply transforms the veoh url to a youtube one
-    and delegates over to `youtube()`
-
-    :param msg: TextMessage that triggered this command response
-    :param id: YouTube video ID
-    """
-    youtube(msg, id)
-
-
-@command('(?P<url>https?://(?:www\.)?vimeo[^\s]+)\"')
-def vimeo(msg: TextMessage, url: str):
-    """Vimeo links display the title of the video linked
-
-    :param msg: TextMessage that triggered this command response
-    :param url: Vimeo URL to read
-    """
-    title = get_url_title(page_url.format(id))
-
-    text = '{} posted a link to <b>{}</b>'.format(
-        msg.user.name,
-        title[:-9] # Title without the `on Vimeo` suffix
-    )
-
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, text)
-
-@command(r'https?://store.steampowered.com/app/(?P<appid>[\d]+)')
-def steam_store(msg: TextMessage, appid: str):
-    """Steam store links that display information about an app
-
-    :param msg: TextMessage that triggered this command response
-    :param appid: Steam App ID
-    """
-    app = SteamApp(appid)
-
-    # Compile final presentation for this steam app
-    html = '{name} posted a link to <b>{app}</b><br/>{short_description}'.format(
-        name=msg.user.name,
-        app=app.name,
-        short_description=app.short_description
-    )
-
-    # Additional context-aware information about the app.
-
-    if app.is_early_access:
-        if app.is_unreleased:
-            html += '<br/><b>Unreleased Early Access Meme</b>'
-        else:
-            html += '<br/><b>Early Access Meme</b>'
-    else:
-        # It's not a meme
-        if app.is_unreleased:
-            html += '<br/><b>Unreleased:</b> Comes out {}'.format(app.release_date['date'])
-
-    # Released app - check for aggregate reviews
-    if not app.is_unreleased:
-        if app.reviews:
-            html += '<br/>' + '<br/>'.join([
-                '<b>{type}:</b> {summary} ({count})'.format(**x) for x in app.reviews
-            ])
-        else:
-            html += '<br/>Not enough reviews'
-
-    # Pricing/discount information
-    html += '<br/><b>Price:</b> {price} {discount}'.format(
-        price=app.price,
-        discount=app.discount
-    )
-
-    # Respond to the channel the link was posted in
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, html)
-
-
-@command(r'https?://steamcommunity.com/(sharedfiles|workshop)/filedetails/.*\?id=(?P<itemid>[\d]+).*')
-def steam_worshop(msg: TextMessage, itemid: str):
-    """Steam workshop links that display information about an item
-
-    :param msg: TextMessage that triggered this command response
-    :param itemid: Workshop item ID
-    """
-    item = SteamWorkshopItem(itemid)
-    item.load_from_api()
-
-    # Compile final presentation for this item
-    html = '{name} posted a link to <b>{title}</b> for {app}'.format(
-        name=msg.user.name,
-        title=item.title,
-        app=item.appname
-    )
-
-    # Tag list (different per item and workshop app)
-    for tag in item.tags:
-        html += '<br/><b>{}:</b> {}'.format(tag[0], tag[1])
-
-    # Respond to the channel the link was posted in
-    for channel in msg.channels:
-        msg.server.sendMessageChannel(channel, False, html)
+    reply(msg, text)
+
+
+# Link previews. These pull in requests, Pillow and the Steam scrapers, so
+# they live in `app.plugins` and are only loaded once a link is posted.
+
+# Seconds from a link being posted to its preview being sent. Whatever
+# hasn't loaded by then (thumbnails, reviews) is left out.
+VIDEO_BUDGET = float(os.environ.get('VIDEO_PREVIEW_BUDGET', '4'))
+STEAM_BUDGET = float(os.environ.get('STEAM_PREVIEW_BUDGET', '6'))
+
+# YouTube regex sourced from https://stackoverflow.com/a/6382259 (with
+# wildcards limited to a single URL so that several links in one message
+# each match)
+lazy_command(
+    'app.plugins.video:youtube',
+    r'(?:youtube(?:-nocookie)?\.com/(?:[^/\s"<>]+/[^\s"<>]+/|(?:v|e(?:mbed)?)/|[^\s"<>]*[?&]v=)|youtu\.be/)(?P<id>[^\"&?/ ]{11})',
+    keywords=('youtube', 'youtu.be'),
+    preview=True,
+    budget=VIDEO_BUDGET,
+    lane=IO
+)
+
+lazy_command(
+    'app.plugins.video:veoh',
+    r'https?://(?:www\.)?veoh.com/watch/yapi-(?P<id>[^\s"]+)\"',
+    keywords=('veoh',),
+    preview=True,
+    budget=VIDEO_BUDGET,
+    lane=IO
+)
+
+lazy_command(
+    'app.plugins.video:vimeo',
+    r'(?P<url>https?://(?:www\.)?vimeo[^\s"]+)\"',
+    keywords=('vimeo',),
+    preview=True,
+    budget=VIDEO_BUDGET,
+    lane=IO
+)
+
+lazy_command(
+    'app.plugins.steam:steam_store',
+    r'https?://store.steampowered.com/app/(?P<appid>[\d]+)',
+    keywords=('store.steampowered',),
+    preview=True,
+    budget=STEAM_BUDGET,
+    lane=IO
+)
+
+lazy_command(
+    'app.plugins.steam:steam_worshop',
+    r'https?://steamcommunity.com/(sharedfiles|workshop)/filedetails/[^\s"<>]*?\?id=(?P<itemid>[\d]+)',
+    keywords=('steamcommunity',),
+    preview=True,
+    budget=STEAM_BUDGET,
+    lane=IO
+)
@@ -0,0 +1,70 @@
+"""
+    Latency budgets for command handlers.
+
+    A deadline is kept in a context variable, so everything a handler calls
+    on its own thread can see how long it has left. Work handed to the
+    fetch and preview pools carries the deadline along with it (see
+    `app.fetch.submit`), and fetches shorten their timeouts to fit it.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_deadline = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised by work that would run past the current deadline"""
+    pass
+
+
+def remaining() -> float:
+    """Seconds left until the current deadline, or None if there isn't one
+
+    Negative once it has passed.
+    """
+    expires = _deadline.get()
+    if expires is None:
+        return None
+
+    return expires - time.monotonic()
+
+
+def check(what: str = 'Work'):
+    """Raise if the current deadline has passed
+
+    :param what: Description of what was about to happen, for the error
+    :raises DeadlineExceeded:
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('{} is past its deadline by {:.0f} ms'.format(what, -left * 1000))
+
+
+@contextmanager
+def deadline(seconds: float = None, at: float = None):
+    """Run the enclosed block under a deadline
+
+    An enclosing deadline that expires sooner still applies.
+
+    :param seconds: Budget from now
+    :param at: Monotonic time to expire at, instead of `seconds`
+    """
+    if at is None:
+        at = None if seconds is None else time.monotonic() + seconds
+
+    current = _deadline.get()
+    if at is None or (current is not None and current < at):
+        at = current
+
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def call_with_deadline(at: float, func: callable, *args, **kwargs):
+    """Call `func` under a deadline expiring at monotonic time `at`"""
+    with deadline(at=at):
+        return func(*args, **kwargs)
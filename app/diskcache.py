@@ -0,0 +1,168 @@
+"""
+    SQLite backed second tier for the preview cache, shared between
+    processes (e.g. the two Werkzeug spawns under DEBUG=1) and restarts.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger('murmur')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS previews (
+    provider TEXT NOT NULL,
+    id TEXT NOT NULL,
+    expires REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (provider, id)
+) WITHOUT ROWID
+'''
+
+# Rows removed per statement when trimming to the size budget
+TRIM_BATCH = 100
+
+
+def encode(value) -> bytes:
+    """Compact binary form of a JSON-able preview value"""
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(data: bytes):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class DiskCache:
+    """Expiring (provider, id) -> value store in an SQLite database
+
+    The database runs in WAL mode so any number of processes can read
+    while one writes. Values must be JSON serializable and are stored
+    zlib compressed. Expiry times are wall clock, so they survive restarts.
+
+    :param path: Database file
+    :param max_bytes: Compressed size budget enforced by `compact`
+    :param clock: Wall clock time source (overridable for testing)
+    :param grace: Seconds `compact` keeps rows past expiry, so they can
+                  still be served stale
+    """
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        clock: callable = time.time,
+        grace: float = 0
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.grace = grace
+
+        self._local = threading.local()
+        self._compactor = None
+
+        db = self._db()
+        db.execute(SCHEMA)
+        db.commit()
+
+        # A file created without incremental auto_vacuum (2), like those
+        # from before `_db` set it ahead of WAL, has to be rebuilt once
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            db.execute('VACUUM')
+
+    def _db(self) -> sqlite3.Connection:
+        """Connection for the calling thread"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+            # Only takes effect on a new database, and only before it's put
+            # in WAL mode - otherwise incremental_vacuum does nothing
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+
+        return db
+
+    def get(self, provider: str, id: str, stale: float = 0):
+        """Return (value, seconds until it expires), or None if missing or expired
+
+        :param stale: Seconds past expiry a row is still returned for, with
+                      a negative time until it expires
+        """
+        row = self._db().execute(
+            'SELECT expires, value FROM previews WHERE provider = ? AND id = ?',
+            (provider, id)
+        ).fetchone()
+
+        if not row:
+            return None
+
+        remaining = row[0] - self.clock()
+        if remaining <= -stale:
+            return None
+
+        return decode(row[1]), remaining
+
+    def set(self, provider: str, id: str, value, ttl: float):
+        """Store a value for `ttl` seconds"""
+        db = self._db()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO previews (provider, id, expires, value) VALUES (?, ?, ?, ?)',
+                (provider, id, self.clock() + ttl, encode(value))
+            )
+
+    def clear(self):
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM previews')
+
+    def compact(self) -> int:
+        """Drop rows expired for longer than `grace`, trim to `max_bytes` and return freed pages to the OS
+
+        :return: Number of rows removed
+        """
+        db = self._db()
+        with db:
+            removed = db.execute('DELETE FROM previews WHERE expires < ?', (self.clock() - self.grace,)).rowcount
+
+            # Over budget: drop whatever was going to expire soonest
+            while (db.execute('SELECT SUM(LENGTH(value)) FROM previews').fetchone()[0] or 0) > self.max_bytes:
+                removed += db.execute(
+                    '''DELETE FROM previews WHERE (provider, id) IN (
+                        SELECT provider, id FROM previews ORDER BY expires LIMIT ?
+                    )''',
+                    (TRIM_BATCH,)
+                ).rowcount
+
+        # Frees one page per step, and execute() only steps it once
+        db.executescript('PRAGMA incremental_vacuum')
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return removed
+
+    def start_compactor(self, interval: float = 10 * 60):
+        """Run `compact` in a background thread every `interval` seconds"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.compact()
+                    logger.debug('Compacted preview disk cache, %d rows removed', removed)
+                except sqlite3.Error:
+                    logger.exception('Preview disk cache compaction failed')
+
+        self._compactor = threading.Thread(target=run, name='diskcache', daemon=True)
+        self._compactor.start()
+
+    def stats(self) -> dict:
+        entries, size = self._db().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM previews'
+        ).fetchone()
+
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes
+        }
@@ -0,0 +1,255 @@
+"""
+    Worker pools for running command handlers off of the Ice dispatch thread.
+"""
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import metrics
+
+logger = logging.getLogger('murmur')
+
+dispatcher = None
+preview_executor = None
+
+# Guards lazy creation of the shared pools above
+_create_lock = threading.Lock()
+
+
+# Lanes commands run on. Interactive commands are pure CPU and finish in
+# microseconds, I/O commands (link previews) wait on the network. Each
+# lane has its own threads and queue, so a flood of previews never holds
+# up a dice roll.
+INTERACTIVE = 'interactive'
+IO = 'io'
+
+
+class Lane:
+    """Threads and queue slots of one dispatcher lane
+
+    :param name: Lane name, used for thread names and stats
+    :param workers: Number of threads running handlers concurrently
+    :param queue_size: Number of handlers that may wait for a free thread
+    """
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='command-' + name
+        )
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.queued = 0
+        self.running = 0
+        self.dropped = 0
+
+
+class Dispatcher:
+    """Bounded pools of worker threads that command handlers are run on
+
+    Ice upcalls (such as `ServerCallback.userTextMessage`) hand matched
+    commands to the dispatcher and return immediately. Each command runs
+    on the lane it was registered with (see `app.commands.subscribe`).
+    At most `workers + queue_size` handlers can be pending on a lane at
+    once - anything past that is dropped instead of backing up the Ice
+    thread pool.
+
+    :param workers: Number of threads per lane, unless set in `lanes`
+    :param queue_size: Number of handlers that may wait for a free thread
+                       per lane, unless set in `lanes`
+    :param lanes: Lane name -> (workers, queue_size) for lanes sized
+                  differently from the defaults above
+    """
+    def __init__(self, workers: int = 4, queue_size: int = 100, lanes: dict = None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lanes = {
+            name: Lane(name, *(lanes or {}).get(name, (workers, queue_size)))
+            for name in (INTERACTIVE, IO)
+        }
+
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def submit(self, name: str, func: callable, *args, lane: str = INTERACTIVE, **kwargs) -> bool:
+        """Queue a handler to be run on a lane's worker pool
+
+        :param name: Command name, used for latency stats
+        :param func: Handler to run
+        :param lane: Lane to run it on (`INTERACTIVE` or `IO`)
+        :return: False if the lane's queue was full and the handler was dropped
+        """
+        lane = self.lanes[lane]
+
+        if not lane.slots.acquire(blocking=False):
+            with self._lock:
+                lane.dropped += 1
+            metrics.commands_dropped.inc(lane.name)
+
+            logger.warning('Dispatch queue %s full, dropping %s', lane.name, name)
+            return False
+
+        with self._lock:
+            lane.queued += 1
+
+        try:
+            lane.executor.submit(self._run, lane, name, time.monotonic(), func, args, kwargs)
+        except RuntimeError:
+            # Executor has been shut down
+            with self._lock:
+                lane.queued -= 1
+            lane.slots.release()
+            return False
+
+        return True
+
+    def _run(self, lane, name, queued_at, func, args, kwargs):
+        started = time.monotonic()
+        with self._lock:
+            lane.queued -= 1
+            lane.running += 1
+
+        failed = False
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            failed = True
+            logger.exception('Command %s failed', name)
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                lane.running -= 1
+                self._record(name, started - queued_at, finished - started, failed)
+            lane.slots.release()
+
+            metrics.command_wait_seconds.observe(started - queued_at, name)
+            metrics.command_seconds.observe(finished - started, name)
+            if failed:
+                metrics.command_failures.inc(name)
+
+    def _record(self, name, wait, elapsed, failed):
+        stats = self._latency.get(name)
+        if not stats:
+            stats = self._latency[name] = {
+                'count': 0,
+                'failed': 0,
+                'wait_total': 0.0,
+                'total': 0.0,
+                'max': 0.0
+            }
+
+        stats['count'] += 1
+        stats['failed'] += failed
+        stats['wait_total'] += wait
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of handlers waiting for a free worker thread, across lanes"""
+        return sum(lane.queued for lane in self.lanes.values())
+
+    def stats(self) -> dict:
+        """Snapshot of queue depth per lane and per-command handler latency (ms)
+
+        Top level `queued`, `running` and `dropped` are totals of all lanes.
+        """
+        with self._lock:
+            commands = {}
+            for name, stats in self._latency.items():
+                commands[name] = {
+                    'count': stats['count'],
+                    'failed': stats['failed'],
+                    'avg_wait_ms': stats['wait_total'] / stats['count'] * 1000,
+                    'avg_ms': stats['total'] / stats['count'] * 1000,
+                    'max_ms': stats['max'] * 1000
+                }
+
+            lanes = {
+                lane.name: {
+                    'workers': lane.workers,
+                    'queue_size': lane.queue_size,
+                    'queued': lane.queued,
+                    'running': lane.running,
+                    'dropped': lane.dropped
+                } for lane in self.lanes.values()
+            }
+
+        return {
+            'queued': sum(lane['queued'] for lane in lanes.values()),
+            'running': sum(lane['running'] for lane in lanes.values()),
+            'dropped': sum(lane['dropped'] for lane in lanes.values()),
+            'lanes': lanes,
+            'commands': commands
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting new handlers and optionally wait for pending ones"""
+        for lane in self.lanes.values():
+            lane.executor.shutdown(wait=wait)
+
+
+def get_dispatcher() -> Dispatcher:
+    """Return the shared dispatcher, creating it on first use
+
+    The I/O lane is sized through the `COMMAND_WORKERS` and
+    `COMMAND_QUEUE_SIZE` environment variables, the interactive lane
+    through `INTERACTIVE_WORKERS` and `INTERACTIVE_QUEUE_SIZE`.
+    """
+    global dispatcher
+
+    with _create_lock:
+        if dispatcher is None:
+            dispatcher = Dispatcher(lanes={
+                INTERACTIVE: (
+                    int(os.environ.get('INTERACTIVE_WORKERS', '2')),
+                    int(os.environ.get('INTERACTIVE_QUEUE_SIZE', '100'))
+                ),
+                IO: (
+                    int(os.environ.get('COMMAND_WORKERS', '4')),
+                    int(os.environ.get('COMMAND_QUEUE_SIZE', '100'))
+                )
+            })
+
+    return dispatcher
+
+
+@metrics.registry.collector
+def _collect():
+    if dispatcher is None:
+        return []
+
+    lanes = dispatcher.stats()['lanes']
+    return [
+        ('sybot_commands_queued', 'gauge', 'Commands waiting for a worker', [
+            ({'lane': name}, lane['queued']) for name, lane in lanes.items()
+        ]),
+        ('sybot_commands_running', 'gauge', 'Commands being run', [
+            ({'lane': name}, lane['running']) for name, lane in lanes.items()
+        ]),
+        ('sybot_lane_workers', 'gauge', 'Threads available to each lane', [
+            ({'lane': name}, lane['workers']) for name, lane in lanes.items()
+        ])
+    ]
+
+
+def get_preview_executor() -> ThreadPoolExecutor:
+    """Return the shared pool that link previews are resolved on
+
+    This is separate from the command pool so that a command fanning out
+    previews never waits on a slot held by itself. Sized through the
+    `PREVIEW_WORKERS` environment variable.
+    """
+    global preview_executor
+
+    with _create_lock:
+        if preview_executor is None:
+            preview_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('PREVIEW_WORKERS', '8')),
+                thread_name_prefix='preview'
+            )
+
+    return preview_executor
@@ -0,0 +1,415 @@
+"""
+    Shared HTTP session for upstream fetches (Steam, YouTube, etc).
+
+    All requests go through a single pooled session so that connections
+    to the handful of hosts we talk to are kept alive between previews.
+"""
+import os
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+
+from app import deadline, metrics
+from app.deadline import DeadlineExceeded
+
+# (connect, read) deadlines in seconds
+TIMEOUT = (
+    float(os.environ.get('FETCH_CONNECT_TIMEOUT', '3.05')),
+    float(os.environ.get('FETCH_READ_TIMEOUT', '10'))
+)
+
+# Responses larger than this are abandoned
+MAX_RESPONSE_BYTES = int(os.environ.get('FETCH_MAX_BYTES', 5 * 1024 * 1024))
+
+# Concurrent connections allowed to any one host. Further requests to
+# that host wait (no longer than the current deadline) for one to finish.
+CONNECTIONS_PER_HOST = int(os.environ.get('FETCH_CONNECTIONS_PER_HOST', '4'))
+
+CHUNK_SIZE = 16 * 1024
+
+# Threads available for `fetch_async` and `submit`. These only ever run a single fetch
+# each, so callers on any other pool can safely block on the results.
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '16'))
+
+# Consecutive failed requests that open a host's circuit, and seconds it
+# stays open before a single request is let through to probe it
+BREAKER_FAILURES = int(os.environ.get('FETCH_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.environ.get('FETCH_BREAKER_RESET', '30'))
+
+
+class FetchException(Exception):
+    pass
+
+
+class ResponseTooLarge(FetchException):
+    pass
+
+
+class CircuitOpen(FetchException):
+    """Raised instead of requesting a host that has been failing"""
+    pass
+
+
+class CircuitBreaker:
+    """Fails fast for a host after repeated connection errors, timeouts or 5xx
+
+    Once `failures` requests in a row have failed the circuit opens, and
+    every request is refused with `CircuitOpen` for `reset` seconds. After
+    that it's half-open: one request is let through as a probe while the
+    rest keep being refused. If the probe succeeds the circuit closes
+    again, otherwise it goes back to open for another `reset` seconds.
+
+    :param failures: Consecutive failures that open the circuit
+    :param reset: Seconds to stay open before probing
+    :param clock: Monotonic time source (overridable for testing)
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(
+        self,
+        failures: int = BREAKER_FAILURES,
+        reset: float = BREAKER_RESET,
+        clock: callable = time.monotonic
+    ):
+        self.failures = failures
+        self.reset = reset
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self._failed = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def before(self, host: str):
+        """Call before each request
+
+        :raises CircuitOpen: If the request shouldn't be made
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+
+            if self.state == self.OPEN and self.clock() - self._opened >= self.reset:
+                # This caller is the probe
+                self.state = self.HALF_OPEN
+                return
+
+        metrics.fetch_short_circuits.inc(host)
+        raise CircuitOpen('{} is failing, not retrying for now'.format(host))
+
+    def record(self, ok: bool):
+        """Call after each request with whether the host answered properly
+
+        :param ok: None if the request was abandoned without an answer
+                   either way. A probe that ends like that lets the next
+                   request probe instead.
+        """
+        with self._lock:
+            if ok is None:
+                if self.state == self.HALF_OPEN:
+                    self.state = self.OPEN
+                return
+
+            if ok:
+                self.state = self.CLOSED
+                self._failed = 0
+                return
+
+            self._failed += 1
+            if self.state == self.HALF_OPEN or self._failed >= self.failures:
+                self.state = self.OPEN
+                self._opened = self.clock()
+
+
+session = requests.Session()
+
+# The pool doesn't block - `_host_slot` limits connections per host
+# instead, since urllib3 would wait for a pooled connection forever
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=CONNECTIONS_PER_HOST
+)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fetch')
+
+_stats_lock = threading.Lock()
+_host_stats = {}
+_breakers = {}
+_slots = {}
+
+
+def fetch(
+    url: str,
+    timeout: tuple = None,
+    max_bytes: int = None,
+    **kwargs
+) -> requests.Response:
+    """GET a URL through the shared session
+
+    The body is read eagerly (so `.content`, `.text` and `.json()` work as
+    usual) but is capped at `max_bytes` and the connection is returned to
+    the pool before this returns.
+
+    Under a deadline (see `app.deadline`), the timeouts are shortened to
+    whatever is left of it.
+
+    :param url: URL to fetch
+    :param timeout: (connect, read) deadlines. Defaults to `TIMEOUT`
+    :param max_bytes: Body size cap. Defaults to `MAX_RESPONSE_BYTES`
+    :param kwargs: Additional arguments passed to `requests.Session.get`
+    :raises ResponseTooLarge: If the body exceeds `max_bytes`
+    :raises CircuitOpen: If the host has been failing (see `CircuitBreaker`)
+    :raises DeadlineExceeded: If the current deadline (see `app.deadline`)
+                              passes before the response is read
+    :raises requests.RequestException: On connection errors and timeouts
+    """
+    if max_bytes is None:
+        max_bytes = MAX_RESPONSE_BYTES
+
+    with closing(_get(url, timeout, CHUNK_SIZE, **kwargs)) as chunks:
+        r = next(chunks)
+
+        # Thrown into the request rather than raised here, so that it's
+        # still recorded as a failure
+        length = r.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            chunks.throw(ResponseTooLarge('{} is {} bytes'.format(url, length)))
+
+        body = bytearray()
+        for chunk in chunks:
+            body += chunk
+            if len(body) > max_bytes:
+                chunks.throw(ResponseTooLarge('{} exceeds {} bytes'.format(url, max_bytes)))
+
+    # Hand the capped body to requests as if it had read it itself
+    r._content = bytes(body)
+    return r
+
+
+def stream(
+    url: str,
+    timeout: tuple = None,
+    max_bytes: int = None,
+    chunk_size: int = CHUNK_SIZE,
+    **kwargs
+):
+    """GET a URL through the shared session, yielding the body in chunks
+
+    Unlike `fetch`, the body is never held by the response. Hitting
+    `max_bytes` simply ends the stream. The connection is closed as soon
+    as the generator is closed, so consumers that find what they need
+    early should stop iterating and close it (e.g. `contextlib.closing`).
+    As with `fetch`, timeouts are shortened to fit the current deadline.
+
+    :param url: URL to fetch
+    :param timeout: (connect, read) deadlines. Defaults to `TIMEOUT`
+    :param max_bytes: Stop after this many bytes. Defaults to `MAX_RESPONSE_BYTES`
+    :param chunk_size: Bytes read per chunk
+    :param kwargs: Additional arguments passed to `requests.Session.get`
+    :raises CircuitOpen: If the host has been failing (see `CircuitBreaker`)
+    :raises DeadlineExceeded: If the current deadline (see `app.deadline`)
+                              passes before the response is read
+    :raises requests.RequestException: On connection errors and timeouts
+    """
+    if max_bytes is None:
+        max_bytes = MAX_RESPONSE_BYTES
+
+    with closing(_get(url, timeout, chunk_size, **kwargs)) as chunks:
+        next(chunks)
+
+        remaining = max_bytes
+        for chunk in chunks:
+            yield chunk[:remaining]
+
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+
+
+def _get(url, timeout, chunk_size, **kwargs):
+    """Request a URL, yielding the response and then its body in chunks
+
+    Holds a connection slot for the host, consults and updates its circuit
+    breaker, and records the request's stats. Closing the generator early
+    counts as a success.
+    """
+    host = urlsplit(url).hostname
+
+    # Waiting for a connection to the host counts against the deadline too
+    with _host_slot(host):
+        timeout, limited = _fit_deadline(url, TIMEOUT if timeout is None else timeout)
+
+        breaker = _breaker(host)
+        breaker.before(host)
+
+        started = time.monotonic()
+        failed = True
+        healthy = False
+
+        try:
+            r = session.get(url, timeout=timeout, stream=True, **kwargs)
+
+            # Only the host being unreachable, slow or erroring counts against
+            # its breaker - an oversized response is still an answer
+            healthy = r.status_code < 500
+
+            try:
+                yield r
+
+                for chunk in r.iter_content(chunk_size):
+                    deadline.check(url)
+                    yield chunk
+            finally:
+                r.close()
+
+            failed = False
+        except GeneratorExit:
+            # Consumer stopped early - that's a success, not a failure
+            failed = False
+            raise
+        except requests.RequestException as e:
+            if limited and _timed_out(e):
+                # Our deadline ran out, which says nothing about the host
+                healthy = None
+                raise DeadlineExceeded('{} timed out at its deadline'.format(url)) from e
+
+            healthy = False
+            raise
+        finally:
+            breaker.record(healthy)
+            _record(host, time.monotonic() - started, failed)
+
+
+def _timed_out(e: requests.RequestException) -> bool:
+    """Whether a request failed by running out of time
+
+    A timeout while reading the body surfaces as a `ConnectionError`
+    wrapping urllib3's `ReadTimeoutError`, rather than `requests.Timeout`.
+    """
+    if isinstance(e, requests.Timeout):
+        return True
+
+    if isinstance(e, requests.ConnectionError) and e.args and isinstance(e.args[0], ReadTimeoutError):
+        return True
+
+    left = deadline.remaining()
+    return left is not None and left <= 0
+
+
+def fetch_async(url: str, **kwargs) -> Future:
+    """Start a `fetch` in the background
+
+    :param url: URL to fetch
+    :param kwargs: Additional arguments passed to `fetch`
+    :return: Future resolving to the `requests.Response`
+    """
+    return submit(fetch, url, **kwargs)
+
+
+def submit(func: callable, *args, **kwargs) -> Future:
+    """Run a function that fetches (and parses) a single resource in the background
+
+    `func` must not itself wait on other work submitted here. It runs
+    under the caller's deadline (see `app.deadline`).
+
+    :param func: Function to run on the fetch pool
+    :return: Future resolving to the return value of `func`
+    """
+    return _executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def _fit_deadline(url, timeout):
+    """Shorten (connect, read) timeouts to what's left of the current deadline
+
+    :return: (timeout, whether it was shortened)
+    :raises DeadlineExceeded: If there's no time left at all
+    """
+    left = deadline.remaining()
+    if left is None:
+        return timeout, False
+
+    deadline.check(url)
+
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+
+    if left >= max(timeout):
+        return timeout, False
+
+    return (min(timeout[0], left), min(timeout[1], left)), True
+
+
+@contextmanager
+def _host_slot(host):
+    """Hold one of the host's `CONNECTIONS_PER_HOST` slots
+
+    :raises DeadlineExceeded: If none frees up before the current deadline
+    """
+    with _stats_lock:
+        slots = _slots.get(host)
+        if not slots:
+            slots = _slots[host] = threading.BoundedSemaphore(CONNECTIONS_PER_HOST)
+
+    left = deadline.remaining()
+    if not slots.acquire(timeout=None if left is None else max(0, left)):
+        raise DeadlineExceeded('No connection to {} free before the deadline'.format(host))
+
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+def _breaker(host) -> CircuitBreaker:
+    with _stats_lock:
+        breaker = _breakers.get(host)
+        if not breaker:
+            breaker = _breakers[host] = CircuitBreaker()
+
+        return breaker
+
+
+def _record(host, elapsed, failed):
+    metrics.fetch_seconds.observe(elapsed, host)
+    if failed:
+        metrics.fetch_failures.inc(host)
+
+    with _stats_lock:
+        stats = _host_stats.get(host)
+        if not stats:
+            stats = _host_stats[host] = {
+                'count': 0,
+                'failed': 0,
+                'total': 0.0,
+                'max': 0.0
+            }
+
+        stats['count'] += 1
+        stats['failed'] += failed
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+
+def stats() -> dict:
+    """Snapshot of per-host request counts and latency (ms)"""
+    with _stats_lock:
+        return {
+            host: {
+                'count': s['count'],
+                'failed': s['failed'],
+                'avg_ms': s['total'] / s['count'] * 1000,
+                'max_ms': s['max'] * 1000,
+                'circuit': _breakers[host].state
+            } for host, s in _host_stats.items()
+        }
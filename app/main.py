@@ -11,7 +11,9 @@ import requests
 
 from flask import Flask
 from app.api import api
+from app.cache import create_disk_cache, preview_cache
 from app.murmur import murmur_connect
+from app.refresh import Refresher
 
 def main(args=None):
     app = Flask(__name__)
@@ -43,14 +45,28 @@ def main(args=None):
     # Register routes
     app.register_blueprint(api)
 
-    # Open an Ice channel to Murmur
+    # Murmur and command logging
     logger = logging.getLogger('murmur')
     logger.setLevel(log_level)
     logger.addHandler(file_handler)
     logger.addHandler(stdout_handler)
 
+    # Share previews with other processes and across restarts, and keep
+    # the file from growing forever
+    preview_cache.disk = create_disk_cache()
+    if preview_cache.disk:
+        preview_cache.disk.start_compactor()
+
+    # Open an Ice channel to Murmur
     murmur_connect(logger)
 
+    # Serve Steam previews from the last known data while they're refreshed
+    preview_cache.refresher = Refresher(
+        preview_cache,
+        interval=float(os.environ.get('PREVIEW_REFRESH_INTERVAL', '60'))
+    )
+    preview_cache.refresher.start()
+
     # Start web service
     app.run(host='::', debug=debug)
 
@@ -0,0 +1,243 @@
+"""
+    Lightweight counters and latency histograms, rendered in the
+    Prometheus text exposition format for the /metrics route.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = None) -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels
+
+    :param name: Metric name
+    :param help: Description shown in the exposition
+    :param labels: Label names. Values are passed positionally to `inc`
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for labels, value in values:
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """Distribution of observed values (usually seconds) in fixed buckets
+
+    :param name: Metric name
+    :param help: Description shown in the exposition
+    :param labels: Label names. Values are passed positionally to `observe`
+    :param buckets: Sorted bucket upper bounds
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            entry = self._values.get(labels)
+            if not entry:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            entry = self._values.get(labels)
+            return sum(entry[0]) if entry else 0
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the time taken by a block (or, as a decorator, a function)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(e[0]), e[1]) for labels, e in self._values.items()]
+
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                yield self.name + '_bucket' + _format_labels(self.labels, labels, le), cumulative
+
+            yield self.name + '_sum' + _format_labels(self.labels, labels), total
+            yield self.name + '_count' + _format_labels(self.labels, labels), cumulative
+
+
+class Registry:
+    """Set of metrics, plus collectors sampled only when rendered"""
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func: callable) -> callable:
+        """Register a function that reports values owned elsewhere
+
+        `func` returns an iterable of (name, type, help, samples) tuples,
+        where samples is a list of (label dict, value) tuples.
+        """
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format"""
+        lines = []
+
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, _format_value(value)))
+
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, type))
+                for labels, value in samples:
+                    lines.append('{}{} {}'.format(
+                        name,
+                        _format_labels(labels.keys(), labels.values()),
+                        _format_value(value)
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+command_seconds = registry.histogram(
+    'sybot_command_seconds', 'Command handler run time', ('command',)
+)
+command_wait_seconds = registry.histogram(
+    'sybot_command_wait_seconds', 'Time commands spent queued for a worker', ('command',)
+)
+command_failures = registry.counter(
+    'sybot_command_failures_total', 'Command handlers that raised', ('command',)
+)
+commands_dropped = registry.counter(
+    'sybot_commands_dropped_total', 'Commands dropped because the queue of their lane was full', ('lane',)
+)
+publish_seconds = registry.histogram(
+    'sybot_publish_seconds', 'Time to route an incoming text message to its command'
+)
+preview_seconds = registry.histogram(
+    'sybot_preview_seconds', 'Time to resolve a single link preview', ('provider',)
+)
+fetch_seconds = registry.histogram(
+    'sybot_fetch_seconds', 'Upstream HTTP request time', ('host',)
+)
+fetch_failures = registry.counter(
+    'sybot_fetch_failures_total', 'Upstream HTTP requests that failed', ('host',)
+)
+fetch_short_circuits = registry.counter(
+    'sybot_fetch_short_circuits_total', 'Upstream HTTP requests refused by an open circuit', ('host',)
+)
+ice_seconds = registry.histogram(
+    'sybot_ice_seconds', 'Murmur Ice call time', ('operation',)
+)
+ice_failures = registry.counter(
+    'sybot_ice_failures_total', 'Murmur Ice calls that raised', ('operation',)
+)
+
+
+@contextmanager
+def ice_call(operation: str):
+    """Measure a synchronous Ice call
+
+    :param operation: Slice operation name (e.g. `getTexture`)
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ice_failures.inc(operation)
+        raise
+    finally:
+        ice_seconds.observe(time.perf_counter() - started, operation)
+
+
+def ice_future(operation: str, future):
+    """Measure an asynchronous Ice call from now until its future completes
+
+    :param operation: Slice operation name (e.g. `getUsers`)
+    :param future: Future returned by the `*Async` proxy method
+    :return: `future`, for chaining
+    """
+    started = time.perf_counter()
+
+    def done(f):
+        ice_seconds.observe(time.perf_counter() - started, operation)
+        if f.exception() is not None:
+            ice_failures.inc(operation)
+
+    future.add_done_callback(done)
+    return future
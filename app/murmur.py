@@ -3,11 +3,13 @@ import os
 import ipaddress
 
 import Ice
-Ice.loadSlice('', ['-I' + Ice.getSliceDir(), 'ice/Murmur.ice'])
-
-import Murmur
 
+from app.slice import Murmur
+from app.cache import texture_cache
 from app.commands import publish
+from app.dispatch import get_dispatcher
+from app.outbox import get_outbox
+from app.presence import presence
 
 meta = None
 
@@ -24,11 +26,14 @@ class MetaCallback(Murmur.MetaCallback):
         """
         self.logger.info('metaCallback started')
 
+        texture_cache.invalidate_server(server.id())
+
         serverR = Murmur.ServerCallbackPrx.uncheckedCast(
-            self.adapter.addWithUUID(ServerCallback(server, current.adapter))
+            self.adapter.addWithUUID(ServerCallback(self.logger, server, current.adapter))
         )
 
         server.addCallback(serverR)
+        presence.seed(server)
 
     def stopped(self, server, current=None):
         """ Called when a server is stopped.
@@ -38,6 +43,9 @@ class MetaCallback(Murmur.MetaCallback):
         """
         self.logger.info('metaCallback stopped')
 
+        presence.server_stopped(server.id())
+        texture_cache.remove_server(server.id())
+
 
 class ServerContextCallback(Murmur.ServerContextCallback):
     """Callback for injecting additional content into the Murmur context menu"""
@@ -53,6 +61,7 @@ class ServerCallback(Murmur.ServerCallback):
     def __init__(self, logger, server, adapter):
         self.logger = logger
         self.server = server
+        self.server_id = server.id()
 
         self.logger.info('ServerCallback bound')
 
@@ -65,26 +74,49 @@ class ServerCallback(Murmur.ServerCallback):
         self.logger.debug('userConnected %s', user)
         self.logger.info('%s connected from %s', user.name, address_to_ipv6(user.address))
 
+        presence.user_connected(self.server_id, user)
+
     def userDisconnected(self, user, current=None):
         self.logger.debug('userDisconnected %s', user)
         self.logger.info('%s disconnected', user.name)
 
+        presence.user_disconnected(self.server_id, user)
+
+        if user.userid >= 0:
+            texture_cache.remove(self.server_id, user.userid)
+
     def userStateChanged(self, user, current=None):
         self.logger.debug('userStateChanged %s', user)
 
+        presence.user_state_changed(self.server_id, user)
+
+        # Murmur doesn't tell us what changed, so assume it may have been
+        # the avatar and have /users recheck it
+        if user.userid >= 0:
+            texture_cache.invalidate(self.server_id, user.userid)
+
     def userTextMessage(self, user, msg, current=None):
         self.logger.debug('userTextMessage %s', user)
-        publish(self.server, user, msg)
+
+        # Matching is cheap, so it happens here - but the command itself is
+        # queued onto the worker pool so this upcall returns immediately
+        publish(self.server, user, msg, get_dispatcher(), get_outbox())
 
     def channelCreated(self, channel, current=None):
         self.logger.debug('channelCreated %s', channel)
 
+        presence.channel_changed(self.server_id, channel)
+
     def channelRemoved(self, channel, current=None):
         self.logger.debug('channelRemoved %s', channel)
 
+        presence.channel_removed(self.server_id, channel)
+
     def channelStateChanged(self, channel, current=None):
         self.logger.debug('channelStateChanged %s', channel)
 
+        presence.channel_changed(self.server_id, channel)
+
 
 def get_murmur_meta():
     return meta
@@ -103,11 +135,22 @@ def murmur_connect(logger):
 
     logger.info('Configuring Ice')
 
+    # Spin up the command worker pool and outbox before any callbacks can arrive
+    get_dispatcher()
+    get_outbox()
+
     props = Ice.createProperties()
     props.setProperty('Ice.ImplicitContext', 'Shared')
     props.setProperty('Ice.MessageSizeMax', '65535')
     props.setProperty('Ice.Default.EncodingVersion', '1.0')
 
+    # Callbacks from Murmur are dispatched on the server thread pool
+    # (a single thread unless configured otherwise)
+    threads = os.environ.get('ICE_SERVER_THREADS')
+    if threads:
+        props.setProperty('Ice.ThreadPool.Server.Size', threads)
+        props.setProperty('Ice.ThreadPool.Server.SizeMax', threads)
+
     idd = Ice.InitializationData()
     idd.properties = props
 
@@ -140,3 +183,9 @@ def murmur_connect(logger):
         )
 
         server.addCallback(serverR)
+
+    # Mirror current state only once callbacks are attached, so every event
+    # after the snapshot is seen. Those that land while it's being taken
+    # are replayed over it by `reconcile`
+    presence.reconcile(meta)
+    presence.start_reconciler(meta)
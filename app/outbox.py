@@ -0,0 +1,241 @@
+"""
+    Outbound queue for channel messages sent by the bot.
+"""
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app import metrics
+
+logger = logging.getLogger('murmur')
+
+outbox = None
+
+_create_lock = threading.Lock()
+
+# Separator between replies merged into one message
+SEPARATOR = '<br/><br/>'
+
+
+class Outbox:
+    """Coalescing, rate limited sender of channel messages
+
+    Replies to the same (server, channel) that arrive within `window`
+    seconds of each other are merged into a single message. Each server
+    then gets a token bucket matching Murmur's `messagelimit` and
+    `messageburst` so the bot is never throttled. While a server is out of
+    tokens its replies keep merging rather than queueing up one by one.
+
+    Urgent replies (those of interactive commands, like dice rolls) skip
+    the coalescing window and take the server's next token ahead of
+    anything else waiting, so they are never stuck behind a flood of link
+    previews - nor do they push the bot over Murmur's limit.
+
+    Messages are sent from a single background thread with asynchronous
+    Ice invocations, so neither it nor the callers wait on Murmur.
+
+    :param window: Seconds to hold a reply for others to merge with it
+    :param rate: Messages per second allowed to each server
+    :param burst: Messages that may be sent back to back before `rate` applies
+    :param max_bytes: Merged messages are split to stay under this size
+                      (Murmur's `imagemessagelength`)
+    :param clock: Monotonic time source (overridable for testing)
+    """
+    def __init__(
+        self,
+        window: float = 0.25,
+        rate: float = 1,
+        burst: int = 5,
+        max_bytes: int = 128 * 1024,
+        clock: callable = time.monotonic
+    ):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.max_bytes = max_bytes
+        self.clock = clock
+
+        # (server, channel, urgent) -> [due time, texts]
+        self._pending = OrderedDict()
+
+        # server -> [tokens, last refill time]
+        self._buckets = {}
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._queued = 0
+        self._sent = 0
+        self._failed = 0
+
+    def send(self, server, channel: int, text: str, urgent: bool = False):
+        """Queue a message to a channel
+
+        :param server: Murmur.ServerPrx to send through
+        :param channel: Channel id
+        :param text: Text or HTML to send
+        :param urgent: Send without waiting to coalesce, ahead of anything
+                       else queued for the server
+        """
+        key = (server, channel, urgent)
+
+        with self._cond:
+            self._queued += 1
+
+            batch = self._pending.get(key)
+            if batch:
+                batch[1].append(text)
+            else:
+                self._pending[key] = [self.clock() + (0 if urgent else self.window), [text]]
+                self._cond.notify()
+
+    def flush(self):
+        """Send everything that is due and within its server's rate limit
+
+        :return: Seconds until something else could be sent, or None if
+                 nothing is pending
+        """
+        with self._cond:
+            messages, wait = self._take(self.clock())
+
+        self._deliver(messages)
+        return wait
+
+    def _take(self, now):
+        messages = []
+        wait = None
+
+        # Urgent batches first, otherwise in the order they were queued
+        for key, batch in sorted(self._pending.items(), key=lambda item: not item[0][2]):
+            server, channel, urgent = key
+            due, texts = batch
+
+            delay = max(due - now, self._refill(server, now))
+            while delay <= 0 and texts:
+                text, texts = self._merge(texts)
+                messages.append((server, channel, text))
+                self._buckets[server][0] -= 1
+                delay = self._refill(server, now)
+
+            if texts:
+                batch[1] = texts
+                wait = delay if wait is None else min(wait, delay)
+            else:
+                del self._pending[key]
+
+        return messages, wait
+
+    def _refill(self, server, now) -> float:
+        """Top up a server's bucket and return seconds until it has a token"""
+        bucket = self._buckets.get(server)
+        if not bucket:
+            bucket = self._buckets[server] = [self.burst, now]
+
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        if bucket[0] >= 1:
+            return 0
+
+        return (1 - bucket[0]) / self.rate
+
+    def _merge(self, texts):
+        """Join as many texts as fit in one message
+
+        :return: (message, texts left over)
+        """
+        size = len(texts[0])
+        count = 1
+
+        while count < len(texts):
+            size += len(SEPARATOR) + len(texts[count])
+            if size > self.max_bytes:
+                break
+            count += 1
+
+        return SEPARATOR.join(texts[:count]), texts[count:]
+
+    def _deliver(self, messages):
+        for server, channel, text in messages:
+            try:
+                future = metrics.ice_future(
+                    'sendMessageChannel',
+                    server.sendMessageChannelAsync(channel, False, text)
+                )
+                future.add_done_callback(self._sent_callback)
+            except Exception:
+                self._sent_callback(None)
+
+    def _sent_callback(self, future):
+        failed = future is None or future.exception() is not None
+
+        with self._cond:
+            if failed:
+                self._failed += 1
+            else:
+                self._sent += 1
+
+        if failed:
+            logger.error(
+                'Failed to send message: %s',
+                future.exception() if future else 'could not be queued'
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                messages, wait = self._take(self.clock())
+                if not messages:
+                    if self._stopping and not self._pending:
+                        return
+
+                    self._cond.wait(wait)
+                    continue
+
+            self._deliver(messages)
+
+    def start(self):
+        """Start sending from a background thread"""
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Send whatever is still pending, then stop the background thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        """Snapshot of queued, sent and pending message counts"""
+        with self._cond:
+            return {
+                'queued': self._queued,
+                'sent': self._sent,
+                'failed': self._failed,
+                'pending': sum(len(batch[1]) for batch in self._pending.values())
+            }
+
+
+def get_outbox() -> Outbox:
+    """Return the shared outbox, creating and starting it on first use
+
+    Configured through the `OUTBOX_WINDOW`, `OUTBOX_RATE` and
+    `OUTBOX_BURST` environment variables.
+    """
+    global outbox
+
+    with _create_lock:
+        if outbox is None:
+            outbox = Outbox(
+                window=float(os.environ.get('OUTBOX_WINDOW', '0.25')),
+                rate=float(os.environ.get('OUTBOX_RATE', '1')),
+                burst=int(os.environ.get('OUTBOX_BURST', '5'))
+            )
+            outbox.start()
+
+    return outbox
@@ -0,0 +1,41 @@
+"""
+    Command implementations with heavy dependencies (HTTP, HTML parsing,
+    image encoding). Their patterns are registered up front in
+    `app.commands` with `lazy_command`, and a module here is only imported
+    the first time one of its commands matches.
+"""
+import functools
+import logging
+
+from requests import RequestException
+
+from app.deadline import DeadlineExceeded
+from app.fetch import FetchException
+from app.util import url_around
+
+logger = logging.getLogger('murmur')
+
+
+def link_only(msg) -> str:
+    """Bare preview naming who posted the link matched in `msg`"""
+    url = url_around(msg.text, msg.match.start(), msg.match.end())
+    return '{} posted a link to <a href="{}">{}</a>'.format(msg.user.name, url, url)
+
+
+def degrades_to_link(func: callable) -> callable:
+    """Decorate a preview to fall back on `link_only` when upstream is unavailable
+
+    Connection errors, timeouts, open circuits (see
+    `app.fetch.CircuitBreaker`) and running out of time (see
+    `app.deadline`) give a link-only preview instead of none.
+    Anything else (e.g. an invalid app id) still fails the preview.
+    """
+    @functools.wraps(func)
+    def wrapper(msg, *args, **kwargs):
+        try:
+            return func(msg, *args, **kwargs)
+        except (RequestException, FetchException, DeadlineExceeded) as e:
+            logger.warning('Preview %s degraded to a link: %r', func.__name__, e)
+            return link_only(msg)
+
+    return wrapper
@@ -0,0 +1,77 @@
+"""
+    Link previews for the Steam store and workshop.
+"""
+from app.commands import TextMessage
+from app.plugins import degrades_to_link
+from app.steam import SteamApp, SteamWorkshopItem
+
+
+@degrades_to_link
+def steam_store(msg: TextMessage, appid: str) -> str:
+    """Steam store links that display information about an app
+
+    :param msg: TextMessage that triggered this command response
+    :param appid: Steam App ID
+    """
+    app = SteamApp(appid)
+
+    # Compile final presentation for this steam app
+    html = '{name} posted a link to <b>{app}</b><br/>{short_description}'.format(
+        name=msg.user.name,
+        app=app.name,
+        short_description=app.short_description
+    )
+
+    # Additional context-aware information about the app.
+
+    if app.is_early_access:
+        if app.is_unreleased:
+            html += '<br/><b>Unreleased Early Access Meme</b>'
+        else:
+            html += '<br/><b>Early Access Meme</b>'
+    else:
+        # It's not a meme
+        if app.is_unreleased:
+            html += '<br/><b>Unreleased:</b> Comes out {}'.format(app.release_date['date'])
+
+    # Released app - check for aggregate reviews (unless the store page
+    # was too slow to get them, in which case they're just left out)
+    if not app.is_unreleased and app.reviews is not None:
+        if app.reviews:
+            html += '<br/>' + '<br/>'.join([
+                '<b>{type}:</b> {summary} ({count})'.format(**x) for x in app.reviews
+            ])
+        else:
+            html += '<br/>Not enough reviews'
+
+    # Pricing/discount information
+    html += '<br/><b>Price:</b> {price} {discount}'.format(
+        price=app.price,
+        discount=app.discount
+    )
+
+    return html
+
+
+@degrades_to_link
+def steam_worshop(msg: TextMessage, itemid: str) -> str:
+    """Steam workshop links that display information about an item
+
+    :param msg: TextMessage that triggered this command response
+    :param itemid: Workshop item ID
+    """
+    item = SteamWorkshopItem(itemid)
+    item.load_from_api()
+
+    # Compile final presentation for this item
+    html = '{name} posted a link to <b>{title}</b> for {app}'.format(
+        name=msg.user.name,
+        title=item.title,
+        app=item.appname
+    )
+
+    # Tag list (different per item and workshop app)
+    for tag in item.tags:
+        html += '<br/><b>{}:</b> {}'.format(tag[0], tag[1])
+
+    return html
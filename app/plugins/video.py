@@ -0,0 +1,81 @@
+"""
+    Link previews for video sites.
+"""
+from requests import RequestException
+
+from app.commands import TextMessage
+from app.deadline import DeadlineExceeded
+from app.fetch import FetchException
+from app.plugins import degrades_to_link
+from app.util import get_url_title, image_url_to_data_uri, strip_suffix, url_around
+
+
+@degrades_to_link
+def youtube(msg: TextMessage, id: str) -> str:
+    """YouTube links display the title of the video linked.
+
+    :param msg: TextMessage that triggered this command response
+    :param id: YouTube video ID
+    """
+    page_url = 'https://www.youtube.com/watch?v={}'
+    thumbnail_url = 'https://img.youtube.com/vi/{}/mqdefault.jpg'
+
+    # Other options:
+    # https://img.youtube.com/vi/I_nkflrpp90/default.jpg - 120x90
+    # https://img.youtube.com/vi/I_nkflrpp90/mqdefault.jpg - 320x180
+    # https://img.youtube.com/vi/I_nkflrpp90/hqdefault.jpg - 480x360
+
+    title = get_url_title(page_url.format(id))
+
+    # The title is enough for a preview if the thumbnail can't make it in time
+    try:
+        thumbnail = image_url_to_data_uri(thumbnail_url.format(id))
+    except (RequestException, FetchException, DeadlineExceeded):
+        thumbnail = None
+
+    # Extract the original youtube URL from the message.
+    # We don't want whatever else is in their message, just the full
+    # url associated with the ID. This is to make a large clickable
+    # link that maintains whatever other context they posted with the
+    # url (timestamp, playlist, etc)
+    original_url = url_around(msg.text, msg.match.start(), msg.match.end())
+
+    # List who posted it, the title, and a linked thumbnail (or just
+    # the link, if the thumbnail couldn't be squeezed into a message)
+    html = '{} posted a link to <b>{}</b><br/><a href="{}">{}</a>'.format(
+        msg.user.name,
+        strip_suffix(title, ' - YouTube'),
+        original_url,
+        '<img src="{}"/>'.format(thumbnail) if thumbnail else original_url
+    )
+
+    return html
+
+
+def veoh(msg: TextMessage, id: str) -> str:
+    """Handle YouTube links that are just rehosted on Veoh
+
+    This method simply transforms the veoh url to a youtube one
+    and delegates over to `youtube()`
+
+    :param msg: TextMessage that triggered this command response
+    :param id: YouTube video ID
+    """
+    return youtube(msg, id)
+
+
+@degrades_to_link
+def vimeo(msg: TextMessage, url: str) -> str:
+    """Vimeo links display the title of the video linked
+
+    :param msg: TextMessage that triggered this command response
+    :param url: Vimeo URL to read
+    """
+    title = get_url_title(url)
+
+    text = '{} posted a link to <b>{}</b>'.format(
+        msg.user.name,
+        strip_suffix(title, ' on Vimeo')
+    )
+
+    return text
@@ -0,0 +1,282 @@
+"""
+    In-memory mirror of Murmur servers, users and channels.
+
+    Seeded from Ice once, kept current from ServerCallback/MetaCallback
+    events, and periodically reconciled against Murmur to repair any drift
+    (missed callbacks, Murmur restarts, etc).
+"""
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import Ice
+
+from app import metrics
+
+logger = logging.getLogger('murmur')
+
+# Seconds between full reconciliation passes against Murmur
+RECONCILE_INTERVAL = float(os.environ.get('PRESENCE_RECONCILE_INTERVAL', '60'))
+
+
+class ServerPresence:
+    """Last known state of one virtual server
+
+    :param proxy: Murmur.ServerPrx for the server
+    :param id: Virtual server id
+    """
+    def __init__(self, proxy, id: int):
+        self.proxy = proxy
+        self.id = id
+        self.name = ''
+        self.host = ''
+        self.port = ''
+        self.running = False
+        self.users = {}
+        self.channels = {}
+
+        # Murmur reports uptime in seconds as of when we asked
+        self._uptime = 0
+        self._uptime_at = time.monotonic()
+
+    @property
+    def uptime(self) -> int:
+        if not self.running:
+            return 0
+
+        return self._uptime + int(time.monotonic() - self._uptime_at)
+
+    def set_uptime(self, uptime: int):
+        self._uptime = uptime
+        self._uptime_at = time.monotonic()
+
+
+class PresenceStore:
+    """Thread-safe view of every virtual server and who is on it
+
+    Events that arrive while `reconcile` or `seed` is waiting on Murmur are
+    recorded and replayed over the new snapshot before it replaces the old
+    one, so nothing that happens mid-snapshot is lost. Murmur sends full state
+    with every event, so replaying one the snapshot already reflects is
+    harmless.
+    """
+    def __init__(self):
+        self._servers = {}
+        self._lock = threading.RLock()
+        self._reconciler = None
+
+        # One event list per snapshot in progress
+        self._journals = []
+
+    def seed(self, server):
+        """(Re)load everything about one server from Murmur
+
+        :param server: Murmur.ServerPrx to load
+        """
+        with self._journal() as journal:
+            presence = self._load(server, self._request(server))
+
+            with self._lock:
+                servers = {presence.id: presence}
+                for apply, args in journal:
+                    apply(servers, *args)
+
+                self._event(self._seeded, servers[presence.id])
+
+    def reconcile(self, meta):
+        """Reload every server from Murmur, replacing the mirrored state
+
+        Every call for every server is put in flight before any is waited
+        on, so this takes about one round trip regardless of server count.
+
+        :param meta: Murmur.MetaPrx
+        """
+        with self._journal() as journal:
+            with metrics.ice_call('getAllServers'):
+                servers = meta.getAllServers()
+
+            pending = [(server, self._request(server)) for server in servers]
+            servers = {
+                presence.id: presence
+                for presence in (self._load(server, futures) for server, futures in pending)
+            }
+
+            with self._lock:
+                for apply, args in journal:
+                    apply(servers, *args)
+
+                self._servers = servers
+
+    @contextmanager
+    def _journal(self):
+        """Record every event until the block exits, to replay over a snapshot"""
+        journal = []
+        with self._lock:
+            self._journals.append(journal)
+
+        try:
+            yield journal
+        finally:
+            with self._lock:
+                self._journals.remove(journal)
+
+    def _event(self, apply: callable, *args):
+        """Apply an event to the mirror, and record it for any snapshot
+        in progress
+
+        :param apply: Function of the servers dict and `args` to apply
+        """
+        with self._lock:
+            apply(self._servers, *args)
+            for journal in self._journals:
+                journal.append((apply, args))
+
+    @staticmethod
+    def _request(server) -> dict:
+        """Start every Ice call needed to mirror a server"""
+        return {
+            'id': metrics.ice_future('id', server.idAsync()),
+            'name': metrics.ice_future('getConf', server.getConfAsync('registername')),
+            'host': metrics.ice_future('getConf', server.getConfAsync('host')),
+            'port': metrics.ice_future('getConf', server.getConfAsync('port')),
+            'running': metrics.ice_future('isRunning', server.isRunningAsync()),
+            'uptime': metrics.ice_future('getUptime', server.getUptimeAsync()),
+            'users': metrics.ice_future('getUsers', server.getUsersAsync()),
+            'channels': metrics.ice_future('getChannels', server.getChannelsAsync())
+        }
+
+    @staticmethod
+    def _load(server, futures: dict) -> ServerPresence:
+        """Build a ServerPresence from the results of `_request`"""
+        presence = ServerPresence(server, futures['id'].result())
+        presence.name = futures['name'].result()
+        presence.host = futures['host'].result()
+        presence.port = futures['port'].result()
+        presence.running = futures['running'].result()
+
+        if presence.running:
+            try:
+                presence.set_uptime(futures['uptime'].result())
+                presence.users = dict(futures['users'].result())
+                presence.channels = dict(futures['channels'].result())
+            except Ice.UserException:
+                # Stopped while we were asking (ServerBootedException)
+                presence.running = False
+                presence.users = {}
+                presence.channels = {}
+
+        return presence
+
+    def start_reconciler(self, meta, interval: float = RECONCILE_INTERVAL):
+        """Run `reconcile` in a background thread every `interval` seconds
+
+        :param meta: Murmur.MetaPrx
+        :param interval: Seconds between passes
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reconcile(meta)
+                except Exception:
+                    logger.exception('Presence reconciliation failed')
+
+        self._reconciler = threading.Thread(target=run, name='presence', daemon=True)
+        self._reconciler.start()
+
+    def server_stopped(self, server_id: int):
+        self._event(self._stopped, server_id)
+
+    def user_connected(self, server_id: int, user):
+        self._event(self._user_connected, server_id, user)
+
+    # Murmur sends the user's full state either way
+    user_state_changed = user_connected
+
+    def user_disconnected(self, server_id: int, user):
+        self._event(self._user_disconnected, server_id, user)
+
+    def channel_changed(self, server_id: int, channel):
+        self._event(self._channel_changed, server_id, channel)
+
+    def channel_removed(self, server_id: int, channel):
+        self._event(self._channel_removed, server_id, channel)
+
+    @staticmethod
+    def _seeded(servers: dict, presence: ServerPresence):
+        servers[presence.id] = presence
+
+    @staticmethod
+    def _stopped(servers: dict, server_id: int):
+        presence = servers.get(server_id)
+        if presence:
+            presence.running = False
+            presence.users = {}
+            presence.channels = {}
+
+    @staticmethod
+    def _user_connected(servers: dict, server_id: int, user):
+        presence = servers.get(server_id)
+        if presence:
+            presence.users[user.session] = user
+
+    @staticmethod
+    def _user_disconnected(servers: dict, server_id: int, user):
+        presence = servers.get(server_id)
+        if presence:
+            presence.users.pop(user.session, None)
+
+    @staticmethod
+    def _channel_changed(servers: dict, server_id: int, channel):
+        presence = servers.get(server_id)
+        if presence:
+            presence.channels[channel.id] = channel
+
+    @staticmethod
+    def _channel_removed(servers: dict, server_id: int, channel):
+        presence = servers.get(server_id)
+        if presence:
+            presence.channels.pop(channel.id, None)
+
+    def servers(self) -> list:
+        """Snapshot of every server, ordered by id"""
+        with self._lock:
+            return [
+                {
+                    'id': p.id,
+                    'name': p.name,
+                    'host': p.host,
+                    'port': p.port,
+                    'isRunning': p.running,
+                    'uptime': p.uptime,
+                    'users': len(p.users)
+                } for _, p in sorted(self._servers.items())
+            ]
+
+    def users(self) -> list:
+        """Snapshot of every connected user
+
+        :return: List of (server id, Murmur.ServerPrx, Murmur.User) tuples
+        """
+        with self._lock:
+            return [
+                (p.id, p.proxy, user)
+                for _, p in sorted(self._servers.items())
+                for _, user in sorted(p.users.items())
+            ]
+
+    def booted(self) -> list:
+        """Running servers as (server id, Murmur.ServerPrx) tuples"""
+        with self._lock:
+            return [(p.id, p.proxy) for _, p in sorted(self._servers.items()) if p.running]
+
+    def channels(self, server_id: int) -> dict:
+        """Snapshot of a server's channels, keyed by channel id"""
+        with self._lock:
+            presence = self._servers.get(server_id)
+            return dict(presence.channels) if presence else {}
+
+
+presence = PresenceStore()
@@ -0,0 +1,125 @@
+"""
+    Background refresh of stale-while-revalidate preview cache entries.
+"""
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger('murmur')
+
+
+class Refresher:
+    """Reloads preview cache entries from a single background thread
+
+    Entries are queued by `PreviewCache.get_or_load` as soon as a stale or
+    nearly expired one is served, and every `interval` seconds the cache is
+    scanned for entries requested within the last `recent` seconds that are
+    coming up on expiry. Whatever was requested most recently is refreshed
+    first, and since there's only the one thread, a burst of expiring
+    entries never turns into a burst of upstream requests.
+
+    :param cache: `app.cache.PreviewCache` to refresh
+    :param interval: Seconds between scans for entries nearing expiry
+    :param recent: Only entries requested this recently are refreshed by a scan
+    """
+    def __init__(self, cache, interval: float = 60, recent: float = 60 * 60):
+        self.cache = cache
+        self.interval = interval
+        self.recent = recent
+
+        # (-last requested, provider, id), with the latest time per key in
+        # _pending so that superseded heap entries can be skipped
+        self._heap = []
+        self._pending = {}
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._refreshed = 0
+        self._failed = 0
+
+    def schedule(self, provider: str, id: str, accessed: float):
+        """Queue an entry to be refreshed
+
+        :param accessed: When it was last requested (the cache's clock).
+                         More recent requests are refreshed first
+        """
+        key = (provider, id)
+
+        with self._cond:
+            if self._pending.get(key, float('-inf')) >= accessed:
+                return
+
+            self._pending[key] = accessed
+            heapq.heappush(self._heap, (-accessed, provider, id))
+            self._cond.notify()
+
+    def _next(self):
+        """Pop the most recently requested key, or None if nothing is queued"""
+        while self._heap:
+            accessed, provider, id = heapq.heappop(self._heap)
+            if self._pending.get((provider, id)) == -accessed:
+                del self._pending[(provider, id)]
+                return provider, id
+
+        return None
+
+    def scan(self):
+        """Queue every recently requested entry that's stale or nearly expired"""
+        for accessed, provider, id in self.cache.refresh_candidates(self.recent):
+            self.schedule(provider, id, accessed)
+
+    def run_once(self) -> bool:
+        """Refresh the highest priority queued entry
+
+        :return: False if nothing was queued
+        """
+        with self._cond:
+            key = self._next()
+
+        if key is None:
+            return False
+
+        try:
+            refreshed = self.cache.refresh(*key)
+        except Exception as e:
+            # The stale value stays cached, so previews keep working
+            logger.warning('Failed to refresh %s %s: %r', key[0], key[1], e)
+            with self._cond:
+                self._failed += 1
+            return True
+
+        if refreshed:
+            with self._cond:
+                self._refreshed += 1
+
+        return True
+
+    def _run(self):
+        next_scan = time.monotonic() + self.interval
+
+        while True:
+            if time.monotonic() >= next_scan:
+                self.scan()
+                next_scan = time.monotonic() + self.interval
+
+            with self._cond:
+                if not self._heap:
+                    self._cond.wait(max(0, next_scan - time.monotonic()))
+                    continue
+
+            self.run_once()
+
+    def start(self):
+        """Start refreshing from a background thread"""
+        self._thread = threading.Thread(target=self._run, name='refresh', daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict:
+        """Snapshot of queued, refreshed and failed refresh counts"""
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'refreshed': self._refreshed,
+                'failed': self._failed
+            }
@@ -0,0 +1,203 @@
+"""
+    Prefiltered routing of text messages to command subscribers.
+"""
+import re
+
+
+class Router:
+    """Routes a message to the first subscribed command whose pattern matches
+
+    Rather than running every command regex against every message, each
+    command can declare cheap literal prefilters when subscribing:
+
+        - `prefix`: the message must start with one of these strings
+          (e.g. `!` for bang commands). Stored in a table keyed by the
+          first character, so a lookup is a single dict hit.
+        - `keywords`: the message must contain one of these substrings
+          (e.g. a domain name). All keywords are combined into one
+          alternation so the message is scanned once for all commands.
+
+    Only commands that pass their prefilter have their full pattern run.
+    Commands that declare neither are always tried. Candidates are tried in
+    registration order, so the first-match-wins behavior is unchanged.
+
+    Commands registered before the first keyword command are tried
+    straight from the first character table. A single character prefix
+    (like `!`) costs nothing there, so anchored bang commands should
+    declare just `!` and let their pattern tell them apart.
+
+    Keywords are matched case-insensitively and should not overlap each
+    other (e.g. `youtube` and `tube.com`) as the scan is non-overlapping.
+    """
+    def __init__(self):
+        self.commands = []
+        self._prefixes = {}
+        self._keywords = {}
+        self._always = 0
+        self._before_keywords = -1
+        self._longest = 0
+        self._leading = {}
+        self._leading_always = ()
+        self._late_prefixes = {}
+        self._scanner = None
+        self._dirty = False
+
+    def add(self, command: dict):
+        """Add a command to the routing table
+
+        :param command: Subscriber dict with `prog` and optional
+                        `prefix` and `keywords` tuples
+        """
+        # Candidate sets are tracked as bitmasks of command indexes,
+        # which keeps the per-message bookkeeping down to a few int ops
+        bit = 1 << len(self.commands)
+        self.commands.append(command)
+
+        prefixes = command.get('prefix') or ()
+        keywords = command.get('keywords') or ()
+
+        for prefix in prefixes:
+            prefix = prefix.lower()
+            self._prefixes.setdefault(prefix[0], []).append((prefix, bit))
+            self._longest = max(self._longest, len(prefix))
+
+        for keyword in keywords:
+            keyword = keyword.lower()
+            self._keywords[keyword] = self._keywords.get(keyword, 0) | bit
+
+        if keywords and self._before_keywords < 0:
+            self._before_keywords = bit - 1
+
+        if not prefixes and not keywords:
+            self._always |= bit
+
+        self._dirty = True
+
+    def _compile(self):
+        # Longest first so that a keyword never shadows a longer one
+        # sharing the same start (alternation is leftmost, not longest).
+        # The scan runs case-sensitively over a lowercased copy of the
+        # message - re.IGNORECASE alternations are several times slower.
+        keywords = sorted(self._keywords, key=len, reverse=True)
+        if keywords:
+            self._scanner = re.compile('|'.join(re.escape(k) for k in keywords))
+        else:
+            self._scanner = None
+
+        # Commands registered before any keyword command, in registration
+        # order under each first character (in either case) they could
+        # match, along with the prefixes still to be checked. A prefix that
+        # is just that character is already satisfied by the dict hit.
+        leading = []
+        for index, command in enumerate(self.commands):
+            if not (1 << index) & self._before_keywords:
+                break
+            prefixes = tuple(p.lower() for p in command.get('prefix') or ())
+            leading.append((prefixes, command))
+
+        self._leading = {}
+        for first in set(p[0] for prefixes, _ in leading for p in prefixes):
+            candidates = []
+            for prefixes, command in leading:
+                if not prefixes or first in prefixes:
+                    candidates.append((None, command))
+                elif any(p[0] == first for p in prefixes):
+                    candidates.append((prefixes, command))
+
+            self._leading[first] = self._leading[first.upper()] = candidates
+
+        self._leading_always = [(None, c) for prefixes, c in leading if not prefixes]
+
+        self._late_prefixes = {}
+        for first, bucket in self._prefixes.items():
+            late = [(prefix, bit) for prefix, bit in bucket if not bit & self._before_keywords]
+            if late:
+                self._late_prefixes[first] = late
+
+        self._dirty = False
+
+    def _first_match(self, mask: int, text: str):
+        while mask:
+            low = mask & -mask
+            command = self.commands[low.bit_length() - 1]
+            match = command['prog'].search(text)
+            if match:
+                return command, match
+            mask ^= low
+
+        return None, None
+
+    def match_all(self, text: str) -> list:
+        """Find every match of every command that passes its prefilter
+
+        :param text: Message contents
+        :return: List of (command, re.Match) tuples in registration order,
+                 then in order of appearance within the message
+        """
+        if self._dirty:
+            self._compile()
+
+        lowered = text.lower()
+        mask = self._always
+
+        for prefix, bit in self._prefixes.get(lowered[:1], ()):
+            if lowered.startswith(prefix):
+                mask |= bit
+
+        if self._scanner:
+            for found in self._scanner.finditer(lowered):
+                mask |= self._keywords[found.group()]
+
+        matches = []
+        while mask:
+            low = mask & -mask
+            command = self.commands[low.bit_length() - 1]
+            matches.extend((command, m) for m in command['prog'].finditer(text))
+            mask ^= low
+
+        return matches
+
+    def match(self, text: str):
+        """Find the first command matching the message
+
+        :param text: Message contents
+        :return: (command, re.Match) tuple, or (None, None) if nothing matched
+        """
+        if self._dirty:
+            self._compile()
+
+        # Candidates registered before any keyword command are tried
+        # straight from the table, without lowercasing or scanning the
+        # message. Their (anchored) regex rejects a message faster than a
+        # prefix check would, so any prefix left is only checked on a match.
+        for prefixes, command in self._leading.get(text[:1], self._leading_always):
+            match = command['prog'].search(text)
+            if match and (
+                prefixes is None
+                or text.startswith(prefixes)
+                or text[:self._longest].lower().startswith(prefixes)
+            ):
+                return command, match
+
+        if self._before_keywords < 0:
+            return None, None
+
+        # Leading candidates have all been tried already
+        lowered = text.lower()
+        mask = self._always & ~self._before_keywords
+
+        for prefix, bit in self._late_prefixes.get(lowered[:1], ()):
+            if lowered.startswith(prefix):
+                mask |= bit
+
+        # Most chat has no keyword at all, which one search settles
+        # without setting up an iterator
+        found = self._scanner.search(lowered) if self._scanner else None
+        while found:
+            mask |= self._keywords[found.group()]
+            found = self._scanner.search(lowered, found.end())
+
+        if not mask:
+            return None, None
+
+        return self._first_match(mask, text)
@@ -0,0 +1,151 @@
+"""
+    Targeted, incremental extraction of a handful of elements from
+    large HTML pages, without building a document tree.
+"""
+import codecs
+import re
+from html.parser import HTMLParser
+
+SELECTOR_PATTERN = re.compile(
+    r'^(?P<tag>[a-z0-9]+)?'
+    r'(?:\.(?P<cls>[\w-]+))?'
+    r'(?:\[(?P<attr>[\w-]+)=["\']?(?P<value>[^"\'\]]*)["\']?\])?$',
+    re.IGNORECASE
+)
+
+# Elements that never have a closing tag
+VOID_TAGS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr'
+}
+
+
+class Selector:
+    """Minimal CSS selector: `tag`, `.class`, `tag.class` or `tag[attr="value"]`
+
+    :param selector: Selector string
+    """
+    def __init__(self, selector: str):
+        match = SELECTOR_PATTERN.match(selector)
+        if not match:
+            raise ValueError('Unsupported selector {}'.format(selector))
+
+        self.tag = match.group('tag')
+        self.cls = match.group('cls')
+        self.attr = match.group('attr')
+        self.value = match.group('value')
+
+    def matches(self, tag: str, attrs: dict) -> bool:
+        if self.tag and self.tag != tag:
+            return False
+
+        if self.cls and self.cls not in (attrs.get('class') or '').split():
+            return False
+
+        if self.attr and attrs.get(self.attr) != self.value:
+            return False
+
+        return True
+
+
+class Extractor(HTMLParser):
+    """Incrementally collects the text or attribute of matching elements
+
+    Feed it the page a chunk at a time and stop as soon as `done` is true -
+    there's no tree, so memory stays flat and the rest of the page is never
+    parsed (or downloaded, when fed from `app.fetch.stream`).
+
+    :param fields: Mapping of field name to a selector string, or to a
+                   (selector, attribute) tuple to capture an attribute
+                   instead of text
+    :param until: Callable given the extractor that returns True once
+                  enough has been collected. Defaults to every field
+                  having at least one value
+    """
+    def __init__(self, fields: dict, until: callable = None):
+        super().__init__(convert_charrefs=True)
+
+        self.fields = []
+        for name, spec in fields.items():
+            selector, attr = spec if isinstance(spec, tuple) else (spec, None)
+            self.fields.append((name, Selector(selector), attr))
+
+        self.until = until
+        self.results = {name: [] for name in fields}
+
+        # (name, value) pairs of every capture in document order
+        self.sequence = []
+
+        # Elements whose text is currently being captured:
+        # [name, tag, depth of same-named tags, text parts]
+        self._open = []
+
+    @property
+    def done(self) -> bool:
+        if self.until:
+            return self.until(self)
+
+        return all(self.results.values())
+
+    def first(self, name: str, default=None):
+        """First value collected for a field"""
+        values = self.results[name]
+        return values[0] if values else default
+
+    def _add(self, name, value):
+        self.results[name].append(value)
+        self.sequence.append((name, value))
+
+    def handle_starttag(self, tag, attrs):
+        for capture in self._open:
+            if capture[1] == tag:
+                capture[2] += 1
+
+        attrs = dict(attrs)
+        for name, selector, attr in self.fields:
+            if selector.matches(tag, attrs):
+                if attr:
+                    self._add(name, attrs.get(attr))
+                elif tag not in VOID_TAGS:
+                    self._open.append([name, tag, 1, []])
+
+    def handle_startendtag(self, tag, attrs):
+        # Self-closing tags can only ever have attributes captured
+        attrs = dict(attrs)
+        for name, selector, attr in self.fields:
+            if attr and selector.matches(tag, attrs):
+                self._add(name, attrs.get(attr))
+
+    def handle_endtag(self, tag):
+        # Only tags of the same name are counted against a capture, which
+        # keeps sloppy markup (unclosed <p>, <li>) inside it from mattering
+        for capture in list(self._open):
+            if capture[1] == tag:
+                capture[2] -= 1
+                if capture[2] == 0:
+                    self._open.remove(capture)
+                    self._add(capture[0], ''.join(capture[3]))
+
+    def handle_data(self, data):
+        for capture in self._open:
+            capture[3].append(data)
+
+
+def extract(chunks, fields: dict, until: callable = None) -> Extractor:
+    """Run an Extractor over an iterable of HTML byte chunks
+
+    Stops consuming `chunks` as soon as the extractor is done.
+
+    :param chunks: Iterable of bytes (e.g. from `app.fetch.stream`)
+    :param fields: See `Extractor`
+    :param until: See `Extractor`
+    """
+    extractor = Extractor(fields, until)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    for chunk in chunks:
+        extractor.feed(decoder.decode(chunk))
+        if extractor.done:
+            break
+
+    return extractor
@@ -0,0 +1,116 @@
+"""
+    Loads the Murmur Slice definitions.
+
+    Rather than compiling `ice/Murmur.ice` on every start (`Ice.loadSlice`),
+    the Python generated by slice2py is cached on disk - along with its
+    bytecode - keyed by a hash of the .ice file and the Ice version. If the
+    cache can't be built or used, this falls back to `Ice.loadSlice`.
+
+    Anything that needs the `Murmur` module should import it from here:
+
+        from app.slice import Murmur
+"""
+import os
+import compileall
+import hashlib
+import importlib
+import logging
+import shutil
+import sys
+import tempfile
+
+import Ice
+import IcePy
+
+logger = logging.getLogger('murmur')
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+MURMUR_SLICE = os.path.join(ROOT, 'ice', 'Murmur.ice')
+
+SLICE_CACHE_DIR = os.environ.get('SLICE_CACHE_DIR', os.path.join(ROOT, '.slice_cache'))
+
+
+def cache_key(path: str) -> str:
+    """Identifies the generated code for a Slice file and Ice version"""
+    digest = hashlib.sha1(Ice.stringVersion().encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+def compile_slice(path: str, cache_dir: str = SLICE_CACHE_DIR) -> str:
+    """Generate (or reuse) the Python for a Slice file
+
+    :param path: Path to the .ice file
+    :param cache_dir: Directory generated code is kept in
+    :return: Directory containing the generated modules
+    """
+    directory = os.path.join(cache_dir, cache_key(path))
+    if os.path.isdir(directory):
+        return directory
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Build somewhere private, then move into place in one step so that a
+    # concurrently starting process never sees a half written cache
+    building = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        status = IcePy.compile([
+            'slice2py',
+            '-I' + Ice.getSliceDir(),
+            '--output-dir', building,
+            path
+        ])
+        if status != 0:
+            raise RuntimeError('slice2py exited with {}'.format(status))
+
+        # Bytecode is most of the saving, so don't leave it to the first import
+        compileall.compile_dir(building, quiet=1)
+
+        # mkdtemp is private to us (0700), but the cache is shared with
+        # whoever else runs the bot, so give it the usual umask permissions
+        # before anyone can see it
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(building, 0o777 & ~umask)
+
+        try:
+            os.rename(building, directory)
+        except OSError:
+            # Someone else got there first
+            if not os.path.isdir(directory):
+                raise
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+
+    return directory
+
+
+def load_slice(path: str, module: str):
+    """Import the module defined by a Slice file
+
+    :param path: Path to the .ice file
+    :param module: Name of the Slice module it defines
+    """
+    if module in sys.modules:
+        return sys.modules[module]
+
+    try:
+        directory = compile_slice(path)
+
+        # Last, so a writable cache directory can never shadow the app or
+        # the standard library
+        if directory not in sys.path:
+            sys.path.append(directory)
+
+        return importlib.import_module(module)
+    except Exception as e:
+        logger.warning('Precompiled slice unavailable (%s), compiling %s', e, path)
+
+    Ice.loadSlice('', ['-I' + Ice.getSliceDir(), path])
+    return importlib.import_module(module)
+
+
+Murmur = load_slice(MURMUR_SLICE, 'Murmur')
@@ -2,15 +2,122 @@
     Steam API integrations (and web scraping) for retrieving
     information about a Steam app or workshop item.
 """
-import requests
-from bs4 import BeautifulSoup
-
+import os
+import logging
+import threading
+import time
+from concurrent.futures import TimeoutError
+from contextlib import closing
+from itertools import takewhile
+
+from requests import RequestException
+
+from app import deadline
+from app.cache import preview_cache
+from app.fetch import FetchException, fetch_async, stream, submit
+from app.scrape import extract
 from app.util import image_url_to_data_uri
 
+logger = logging.getLogger('murmur')
+
+# Seconds (from the start of loading an app) that we'll wait on the store
+# page for reviews before giving up and previewing without them
+REVIEWS_DEADLINE = float(os.environ.get('STEAM_REVIEWS_DEADLINE', '2.5'))
+
+# Apps loaded without reviews are only cached briefly so the next
+# repost gets another shot at them
+PARTIAL_TTL = 60
+
 class SteamApiException(Exception):
     pass
 
 
+REVIEW_CAPTIONS = ('Recent Reviews:', 'All Reviews:')
+
+def group_reviews(page) -> list:
+    """Pair review captions with the summary and count that follow them
+
+    Mirrors the store page layout, where each `div.subtitle` caption is
+    followed (in the same row) by a `span.game_review_summary` and a
+    `span.responsive_hidden` holding the review count in parentheses.
+
+    :param page: `app.scrape.Extractor` run over a store page
+    """
+    reviews = []
+    current = None
+
+    for name, value in page.sequence:
+        value = value.strip()
+
+        if name == 'subtitle':
+            current = {'type': value[:-1]} if value in REVIEW_CAPTIONS else None
+        elif current is not None and name not in current:
+            current[name] = value
+
+            if 'summary' in current and 'count' in current:
+                reviews.append({
+                    'type': current['type'],
+                    'summary': current['summary'],
+                    'count': current['count'][1:-1]
+                })
+                current = None
+
+    return reviews
+
+
+def scrape_reviews(chunks) -> list:
+    """Extract recent and all-time review summaries from a store page
+
+    Parsing stops as soon as the all-time summary has been read, which is
+    near the top of the page.
+
+    :param chunks: Iterable of store page HTML bytes
+    """
+    page = extract(
+        chunks,
+        {
+            'subtitle': 'div.subtitle',
+            'summary': 'span.game_review_summary',
+            'count': 'span.responsive_hidden'
+        },
+        until=lambda page: any(r['type'] == 'All Reviews' for r in group_reviews(page))
+    )
+
+    return group_reviews(page)
+
+
+def scrape_workshop_item(chunks) -> dict:
+    """Extract the title, app name, logo and tags from a workshop page
+
+    Parsing stops at the stats block that follows the tags.
+
+    :param chunks: Iterable of workshop page HTML bytes
+    """
+    page = extract(
+        chunks,
+        {
+            'appname': '.apphub_AppName',
+            'title': '.workshopItemTitle',
+            'logo': ('link[rel="image_src"]', 'href'),
+            'tags': 'div.workshopTags',
+            'end': ('div.detailsStatsContainerLeft', 'class')
+        },
+        until=lambda page: all(page.results[k] for k in ('appname', 'title', 'logo', 'end'))
+    )
+
+    if not page.first('title'):
+        raise SteamApiException('Invalid Workshop Item')
+
+    return {
+        'appname': page.first('appname'),
+        'title': page.first('title'),
+        'logo': page.first('logo'),
+
+        # Variable number of tags and items per workshop item
+        'tags': [tag.split(':\xa0') for tag in page.results['tags']]
+    }
+
+
 class SteamApp:
     """Information about a specific Steam app on the store
 
@@ -43,44 +150,74 @@ class SteamApp:
         }
 
     def load_from_api(self):
-        """Populate attributes from available Steam APIs"""
+        """Populate attributes from available Steam APIs
+
+        Results are shared through the preview cache, so reposts of the
+        same app within the cache TTL don't hit Steam again.
+        """
+        loaded = preview_cache.get_or_load(
+            'steam_app',
+            self.appid,
+            self._fetch,
+            ttl=lambda loaded: None if loaded['scraped']['reviews'] is not None else PARTIAL_TTL
+        )
+
+        self.data = loaded['data']
+        self.scraped = loaded['scraped']
+        self.loaded = True
 
+    def _fetch(self) -> dict:
         details_api = 'https://store.steampowered.com/api/appdetails/?appids={}&cc=us&l=en&json=1'
         # reviews_api = 'https://store.steampowered.com/appreviews/{}?json=1'
         store_url = 'https://store.steampowered.com/app/{}'
 
-        # TODO: Async this up
-        r = requests.get(details_api.format(self.appid))
-        details_json = r.json()
-
-        # Make sure the API is bringing back real app data
-        if not details_json or not details_json[self.appid]['success']:
-            raise SteamApiException('Invalid App ID')
-
-        self.data = details_json[self.appid]['data']
-
-        # Reviews - scraped from the store page since the official API only
-        # provides overall review aggregation and not a split for recent vs all
-        r = requests.get(store_url.format(self.appid))
-        soup = BeautifulSoup(r.content, features='html.parser')
-
-        for subtitle in soup.select('div.subtitle'):
-            for caption in subtitle.stripped_strings:
-                if caption == 'Recent Reviews:' or caption == 'All Reviews:':
-                    summary = subtitle.parent.select('span.game_review_summary')
-
-                    # These next two are horrible selectors, but it's all we got :(
-                    count = subtitle.parent.select('span.responsive_hidden')
-                    # desc = subtitle.parent.select('span.responsive_reviewdesc')
-
-                    if summary and count:
-                        self.scraped['reviews'].append({
-                            'type': caption[:-1],
-                            'summary': summary[0].get_text(strip=True),
-                            'count': count[0].get_text(strip=True)[1:-1]
-                        })
+        # Both requests go out at once - the store page is only needed for
+        # reviews, so it's allowed to miss its deadline
+        started = time.monotonic()
+        abandoned = threading.Event()
+        details = fetch_async(details_api.format(self.appid))
+        store = submit(self._load_reviews, store_url.format(self.appid), abandoned)
+
+        try:
+            left = deadline.remaining()
+            try:
+                details_json = details.result(timeout=None if left is None else max(0, left)).json()
+            except TimeoutError:
+                details.cancel()
+                raise deadline.DeadlineExceeded('Steam app {} details missed the deadline'.format(self.appid))
+
+            # Make sure the API is bringing back real app data
+            if not details_json or not details_json[self.appid]['success']:
+                raise SteamApiException('Invalid App ID')
+
+            # Reviews - scraped from the store page since the official API only
+            # provides overall review aggregation and not a split for recent vs all
+            wait = started + REVIEWS_DEADLINE - time.monotonic()
+            left = deadline.remaining()
+            if left is not None:
+                wait = min(wait, left)
+
+            try:
+                reviews = store.result(timeout=max(0, wait))
+            except (TimeoutError, deadline.DeadlineExceeded, RequestException, FetchException) as e:
+                logger.warning('Skipping reviews for app %s: %r', self.appid, e)
+                reviews = None
+        finally:
+            # Stop the store page load if nobody is waiting on it any more
+            store.cancel()
+            abandoned.set()
+
+        return {
+            'data': details_json[self.appid]['data'],
+            'scraped': {
+                'reviews': reviews
+            }
+        }
 
-        self.loaded = True
+    def _load_reviews(self, url: str, abandoned: threading.Event) -> list:
+        with closing(stream(url)) as chunks:
+            # Closes the connection as soon as the caller has given up
+            return scrape_reviews(takewhile(lambda chunk: not abandoned.is_set(), chunks))
 
     @property
     def price(self) -> str:
@@ -142,7 +279,8 @@ class SteamApp:
 
         Example: ['All Reviews: Mixed (10)', 'Recent Reviews: Mixed (5)']
 
-        May exclude 'Recent Reviews' if it's not old enough
+        May exclude 'Recent Reviews' if it's not old enough.
+        None if the store page couldn't be loaded in time.
         """
         if not self.loaded:
             self.load_from_api()
@@ -211,19 +349,18 @@ class SteamWorkshopItem:
         }
 
     def load_from_api(self):
-        workshop_url = 'https://steamcommunity.com/sharedfiles/filedetails/?id={}'
+        """Populate attributes by scraping the workshop page
 
-        r = requests.get(workshop_url.format(self.itemid))
-        soup = BeautifulSoup(r.content, features='html.parser')
+        Results are shared through the preview cache.
+        """
+        self.scraped = preview_cache.get_or_load('steam_workshop', self.itemid, self._fetch)
+        self.loaded = True
 
-        # Extract basic info (item name, app name)
-        self.scraped['appname'] = soup.select_one('.apphub_AppName').text
-        self.scraped['title'] = soup.select_one('.workshopItemTitle').text
-        self.scraped['logo'] = soup.select_one('link[rel="image_src"]')['href']
+    def _fetch(self) -> dict:
+        workshop_url = 'https://steamcommunity.com/sharedfiles/filedetails/?id={}'
 
-        # Extract tags (variable number of tags and items per workshop item)
-        for tag in soup.select('div.workshopTags'):
-            self.scraped['tags'].append(tag.text.split(':\xa0'))
+        with closing(stream(workshop_url.format(self.itemid))) as chunks:
+            scraped = scrape_workshop_item(chunks)
 
         """
         Scraping ratings would be nice, but not very doable right now.
@@ -231,7 +368,7 @@ class SteamWorkshopItem:
         filename (e.g. 4-star_large.png) but no other data on the page.
         """
 
-        self.loaded = True
+        return scraped
 
     @property
     def tags(self) -> list:
@@ -2,48 +2,172 @@
 import zlib
 from PIL import Image
 from io import BytesIO
+from contextlib import closing
 
+import os
 import base64
 import re
-import requests
-# from bs4 import BeautifulSoup
+
+from app.cache import preview_cache
+from app.fetch import fetch, stream
+
+# Largest data URI embedded for a single image. Murmur drops messages
+# longer than its `imagemessagelength` (128 KiB by default), and a merged
+# preview reply can carry more than one image.
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 48 * 1024))
+
+# Images are never sent larger than this (width or height) in pixels
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 480))
+
+# Re-encoding gives up once an image has been shrunk this small
+IMAGE_MIN_DIMENSION = 64
+
+JPEG_QUALITIES = (85, 70, 55, 40)
 
 def image_url_to_data_uri(url: str) -> str:
     """Returns a base 64 data URI version of the source URL image
 
+    The image is downsized and re-encoded as needed to fit within
+    `IMAGE_MAX_BYTES`. Encoded results are cached by source URL.
+
     :param url: Source URL
+    :return: Data URI, or None if the image couldn't be decoded or fit
     """
-    r = requests.get(url)
+    return preview_cache.get_or_load(
+        'image',
+        url,
+        lambda: image_to_data_uri(fetch(url).content, IMAGE_MAX_BYTES),
+        ttl=lambda uri: 60 if uri is None else None
+    )
 
-    # TODO: Automatic image compression for images that will be too large to send.
-    # Probably use PIL to resize the source image and then b64 that.
+def image_to_data_uri(content: bytes, max_bytes: int) -> str:
+    """Encode image data as a data URI no longer than `max_bytes`
 
-    uri = 'data:{};base64,{}'.format(
-        r.headers['Content-Type'],
-        base64.b64encode(r.content).decode('utf-8') # str(base64.b64encode(r.content).decode("utf-8")))
-    )
+    Images that already fit are passed through untouched. Otherwise the
+    image is scaled down to `IMAGE_MAX_DIMENSION` and then encoded at
+    decreasing quality, and further downscaled, until it fits.
+
+    :param content: Source image data (any format Pillow can decode)
+    :param max_bytes: Budget for the length of the resulting data URI
+    :return: Data URI, or None if the image couldn't be decoded or fit
+    """
+    try:
+        image = Image.open(BytesIO(content))
+    except OSError:
+        return None
+
+    mime = Image.MIME.get(image.format)
+    if mime and _data_uri_length(mime, len(content)) <= max_bytes \
+            and max(image.size) <= IMAGE_MAX_DIMENSION:
+        return _data_uri(mime, content)
+
+    # Let the JPEG decoder skip straight to (roughly) the target size
+    image.draft('RGB', (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+
+    try:
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    except OSError:
+        return None
+
+    # Transparent images get a shot at PNG before being flattened to JPEG
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if has_alpha:
+        image = image.convert('RGBA')
+
+    while True:
+        if has_alpha:
+            data = _encode(image, 'PNG', optimize=True)
+            if _data_uri_length('image/png', len(data)) <= max_bytes:
+                return _data_uri('image/png', data)
+
+        flattened = _flatten(image)
+        for quality in JPEG_QUALITIES:
+            data = _encode(flattened, 'JPEG', quality=quality, optimize=True)
+            if _data_uri_length('image/jpeg', len(data)) <= max_bytes:
+                return _data_uri('image/jpeg', data)
+
+        width, height = image.size
+        if min(width, height) * 3 // 4 < IMAGE_MIN_DIMENSION:
+            return None
+
+        image = image.resize((width * 3 // 4, height * 3 // 4), Image.LANCZOS)
+
+def _flatten(image):
+    """Convert to RGB, compositing any transparency onto white"""
+    if image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
 
-    return uri
+    return image.convert('RGB')
+
+def _encode(image, format: str, **options) -> bytes:
+    buffered = BytesIO()
+    image.save(buffered, format=format, **options)
+    return buffered.getvalue()
+
+def _data_uri(mime: str, data: bytes) -> str:
+    return 'data:{};base64,{}'.format(mime, base64.b64encode(data).decode('utf-8'))
+
+def _data_uri_length(mime: str, size: int) -> int:
+    # 'data:' + mime + ';base64,' + base64 (4 chars per 3 bytes, padded)
+    return 13 + len(mime) + (size + 2) // 3 * 4
+
+NO_TITLE = 'No Title'
+
+# Stop looking for a title after this much of the page. The <title> of
+# most pages (even YouTube's huge ones) is near the top of <head>.
+TITLE_MAX_BYTES = int(os.environ.get('TITLE_MAX_BYTES', 1024 * 1024))
+
+TITLE_PATTERN = re.compile(rb'<title[^>]*>(?P<title>.*?)</title>', re.IGNORECASE | re.DOTALL)
+OG_TITLE_PATTERN = re.compile(
+    rb'<meta\s+(?:property|name)=["\']og:title["\']\s+content=["\'](?P<title>[^"\']*)["\']',
+    re.IGNORECASE
+)
 
 def get_url_title(url: str) -> str:
-    """Extract the <title> element from a page and return
+    """Extract the <title> (or og:title) of a page and return
+
+    The page is streamed and the download stops as soon as a title is
+    found, rather than pulling the whole (often megabyte+) page.
+    Results are cached by URL.
 
     :param url: URL to grab HTML from
     """
-    r = requests.get(url)
+    return preview_cache.get_or_load(
+        'title',
+        url,
+        lambda: _load_title(url),
+        ttl=lambda title: 60 if title == NO_TITLE else None
+    )
 
+def _load_title(url: str) -> str:
     # Soup is slow - especially for insane DOMs like YouTube.
-    # soup = BeautifulSoup(r.content, features='html.parser')
+    buffer = b''
+
+    with closing(stream(url, max_bytes=TITLE_MAX_BYTES)) as chunks:
+        for chunk in chunks:
+            # Only search what's new (plus enough overlap for a tag
+            # split across chunks) so the whole scan stays linear
+            start = max(0, len(buffer) - 4096)
+            buffer += chunk
 
-    # titles = soup.find_all('title')
-    # if titles:
-    #     return titles[0].get_text(strip=True)
+            match = TITLE_PATTERN.search(buffer, start) or OG_TITLE_PATTERN.search(buffer, start)
+            if match:
+                return match.group('title').decode('utf-8', errors='replace').strip()
 
-    match = re.search("<title>(?P<title>.*)</title>", r.text, re.IGNORECASE)
-    if match:
-        return match.group('title')
+    return NO_TITLE
 
-    return 'No Title'
+def strip_suffix(text: str, suffix: str) -> str:
+    """Remove a suffix from text, if present
+
+    :param text: Text to strip
+    :param suffix: Suffix to remove (e.g. ` - YouTube`)
+    """
+    if text.endswith(suffix):
+        return text[:-len(suffix)]
+
+    return text
 
 def texture_to_data_uri(texture) -> str:
     """Convert a Murmur Texture to a data uri encoded PNG"""
@@ -54,7 +178,7 @@ def texture_to_data_uri(texture) -> str:
     # Murmur gives us the *original* image data, so we want
     # to try to decode that, crush it to an avatar size, and encode
     image = Image.open(BytesIO(texture))
-    image.thumbnail((128, 128), Image.ANTIALIAS)
+    image.thumbnail((128, 128), Image.LANCZOS)
 
     # Convert image to PNG string
     buffered = BytesIO()
@@ -69,3 +193,23 @@ def strip_html(html: str) -> str:
     :param html: content to strip
     """
     return re.sub('<[^<]+?>', '', html)
+
+def url_around(text: str, start: int, end: int) -> str:
+    """Expand a span of text out to the whole URL it is part of
+
+    URLs are delimited by whitespace, quotes, or tag brackets - which
+    covers both plain text and links inside of an <a> tag.
+
+    :param text: Text containing the URL
+    :param start: Start index of a span within the URL
+    :param end: End index of a span within the URL
+    """
+    delimiters = ' \t\r\n"\'<>'
+
+    while start > 0 and text[start - 1] not in delimiters:
+        start -= 1
+
+    while end < len(text) and text[end] not in delimiters:
+        end += 1
+
+    return text[start:end]
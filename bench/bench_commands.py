@@ -0,0 +1,353 @@
+"""
+    Offline benchmark of the whole command pipeline: `app.commands.publish`
+    driven with message corpora against a mock Murmur server.
+
+    Every upstream request (YouTube pages and thumbnails, Steam appdetails,
+    store and workshop pages) is answered by a local HTTP stub serving
+    recorded pages from test/fixtures, so this runs without any network.
+
+    Reports messages/sec, p50/p99 latency per message and peak allocations
+    for a single pass over each corpus. Results can be saved and later
+    compared against to gate regressions:
+
+    Usage: python -m bench.bench_commands [--seconds N] [--save FILE]
+                                          [--compare FILE] [--tolerance 0.2]
+"""
+import argparse
+import io
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from app import fetch
+from app.cache import preview_cache
+from app.commands import publish
+from app.slice import Murmur
+
+from bench.bench_router import CORPUS as ROUTER_CORPUS
+from bench.bench_scrape import load_page
+
+YOUTUBE_IDS = ['dQw4w9WgXcQ', 'I_nkflrpp90', '9bZkp7q19f0', 'kJQP7kiw5Fk']
+STEAM_APPIDS = ['440', '570', '730', '4000']
+WORKSHOP_IDS = ['104603291', '123456', '2183845413']
+
+
+def link(url):
+    """A link as the Mumble client sends it"""
+    return '<a href="{0}">{0}</a>'.format(url)
+
+
+def youtube(id):
+    return link('https://www.youtube.com/watch?v=' + id)
+
+
+def steam_store(appid):
+    return link('https://store.steampowered.com/app/{}/'.format(appid))
+
+
+def steam_workshop(itemid):
+    return link('https://steamcommunity.com/sharedfiles/filedetails/?id=' + itemid)
+
+
+LINKS = (
+    [youtube(id) for id in YOUTUBE_IDS] +
+    [steam_store(appid) for appid in STEAM_APPIDS] +
+    [steam_workshop(itemid) for itemid in WORKSHOP_IDS] +
+    [
+        # Several links in one message
+        'check these out ' + youtube(YOUTUBE_IDS[0]) + ' and ' + steam_store(STEAM_APPIDS[0]),
+        steam_workshop(WORKSHOP_IDS[0]) + ' ' + steam_workshop(WORKSHOP_IDS[1]) + ' ' + youtube(YOUTUBE_IDS[1])
+    ]
+)
+
+CORPUS = {
+    'plain': ROUTER_CORPUS['plain'],
+    'dice': ['!2d6', '!1d20', '!5d4', '!0d6', '!9d9'],
+    'pickone': [
+        '!pickone Gfro, Phantom, Mark',
+        '!pickone pizza, tacos, burgers, sushi, nothing',
+        '!pickone yes, no'
+    ],
+    'links': LINKS
+}
+
+
+def mixed_corpus(size=200, seed=1):
+    """Traffic in rough real-world proportions: mostly chat, some commands and links"""
+    rng = random.Random(seed)
+    commands = CORPUS['dice'] + CORPUS['pickone'] + ['hi', '!help']
+
+    return [
+        rng.choice(rng.choices(
+            [CORPUS['plain'], commands, LINKS],
+            weights=[80, 12, 8]
+        )[0]) for _ in range(size)
+    ]
+
+
+class Pages:
+    """Recorded upstream responses, keyed by what the stub is asked for"""
+    def __init__(self):
+        self.store = load_page('steam_store.html', 800 * 1024)
+        self.workshop = load_page('steam_workshop.html', 400 * 1024)
+
+        # Real thumbnails are noisy photos, so they don't compress to nothing
+        image = Image.effect_noise((320, 180), 48).convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        self.thumbnail = buffer.getvalue()
+
+    def youtube(self, query):
+        id = query.partition('v=')[2]
+        head = '<html><head><title>Video {} - YouTube</title></head><body>'.format(id)
+        return head.encode() + b'<script>' + b'x' * 600 * 1024 + b'</script></body></html>'
+
+    def appdetails(self, query):
+        appid = query.split('appids=')[1].split('&')[0]
+        return json.dumps({
+            appid: {
+                'success': True,
+                'data': {
+                    'name': 'App {}'.format(appid),
+                    'short_description': 'A recorded description of app {}.'.format(appid),
+                    'is_free': False,
+                    'price_overview': {'final': 1999, 'discount_percent': 50},
+                    'genres': [{'description': 'Action'}, {'description': 'Indie'}],
+                    'release_date': {'coming_soon': False, 'date': 'Aug 7, 2018'},
+                    'header_image': 'https://cdn.akamai.steamstatic.com/steam/apps/{}/header.jpg'.format(appid)
+                }
+            }
+        }).encode()
+
+    def get(self, host, path, query):
+        """Return (content type, body) for a rewritten request"""
+        if host.endswith('youtube.com') and path == '/watch':
+            return 'text/html', self.youtube(query)
+
+        if host == 'store.steampowered.com' and path.startswith('/api/appdetails'):
+            return 'application/json', self.appdetails(query)
+
+        if host == 'store.steampowered.com':
+            return 'text/html', self.store
+
+        if host == 'steamcommunity.com':
+            return 'text/html', self.workshop
+
+        # Thumbnails, logos, header images
+        return 'image/jpeg', self.thumbnail
+
+
+def create_stub(pages):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            host, _, path = parts.path[1:].partition('/')
+
+            content_type, body = pages.get(host, '/' + path, parts.query)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # Streamed pages are abandoned as soon as their data is found
+            pass
+
+    return StubServer(('127.0.0.1', 0), StubHandler)
+
+
+class StubAdapter(HTTPAdapter):
+    """Sends every request to the local stub as `/<host><path>?<query>`
+
+    :param address: host:port of the stub
+    """
+    def __init__(self, address, **kwargs):
+        self.address = address
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = 'http://{}/{}{}{}'.format(
+            self.address,
+            parts.hostname,
+            parts.path or '/',
+            '?' + parts.query if parts.query else ''
+        )
+
+        return super().send(request, **kwargs)
+
+
+class BenchServer(Murmur.Server):
+    """Mock Murmur server that only counts what the bot sends"""
+    def __init__(self):
+        super().__init__()
+        self.replies = 0
+
+    def sendMessageChannel(self, channel, tree, text):
+        self.replies += 1
+
+    def sendMessage(self, session, text):
+        self.replies += 1
+
+
+def create_user():
+    user = Murmur.User()
+    user.session = 1
+    user.name = 'Bench'
+
+    return user
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))]
+
+
+def run_corpus(server, user, messages, seconds, cold):
+    """Publish messages in a loop for `seconds`
+
+    :param cold: Clear the preview cache before every message, so every
+                 link is fetched and encoded from scratch
+    :return: Dict of msg_per_sec, p50_ms, p99_ms and peak_kib
+    """
+    def send(text):
+        if cold:
+            preview_cache.clear()
+
+        publish(server, user, Murmur.TextMessage([], [0], [], text))
+
+    # Warm up (and, for warm runs, fill the cache), then trace one pass
+    for text in messages:
+        send(text)
+
+    tracemalloc.start()
+    for text in messages:
+        send(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+    started = time.perf_counter()
+    deadline = started + seconds
+
+    while time.perf_counter() < deadline:
+        for text in messages:
+            sent = time.perf_counter()
+            send(text)
+            latencies.append(time.perf_counter() - sent)
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    return {
+        'msg_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_kib': peak / 1024
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return regressions against a saved baseline as printable strings"""
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        if result['msg_per_sec'] < base['msg_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:,.0f} msg/s, baseline {:,.0f}'.format(
+                name, result['msg_per_sec'], base['msg_per_sec']
+            ))
+
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append('{}: p99 {:.2f} ms, baseline {:.2f} ms'.format(
+                name, result['p99_ms'], base['p99_ms']
+            ))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--seconds', type=float, default=2.0, help='Time spent on each corpus')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Fail if slower than the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown when comparing')
+    args = parser.parse_args(argv)
+
+    stub = create_stub(Pages())
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    adapter = StubAdapter(
+        '127.0.0.1:{}'.format(stub.server_port),
+        pool_maxsize=fetch.FETCH_WORKERS,
+        pool_block=True
+    )
+    fetch.session.mount('http://', adapter)
+    fetch.session.mount('https://', adapter)
+
+    server = BenchServer()
+    user = create_user()
+
+    runs = [
+        ('plain', CORPUS['plain'], False),
+        ('dice', CORPUS['dice'], False),
+        ('pickone', CORPUS['pickone'], False),
+        ('links cold', CORPUS['links'], True),
+        ('links warm', CORPUS['links'], False),
+        ('mixed', mixed_corpus(), False)
+    ]
+
+    print('{:<12} {:>12} {:>10} {:>10} {:>10}'.format('corpus', 'msg/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+
+    results = {}
+    for name, messages, cold in runs:
+        preview_cache.clear()
+        result = results[name] = run_corpus(server, user, messages, args.seconds, cold)
+
+        print('{:<12} {:>12,.0f} {:>10.3f} {:>10.3f} {:>10,.0f}'.format(
+            name,
+            result['msg_per_sec'],
+            result['p50_ms'],
+            result['p99_ms'],
+            result['peak_kib']
+        ))
+
+    stub.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
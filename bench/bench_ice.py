@@ -0,0 +1,258 @@
+"""
+    End-to-end load generator: a local Ice stand-in for Murmur that boots
+    many virtual servers, connects the bot to it through `murmur_connect`
+    and fires `userTextMessage` / `userStateChanged` callbacks at it.
+
+    The bot's replies come back over Ice to the fake servers, which match
+    them up with the message that caused them to measure end-to-end
+    latency. This exercises the callback adapter, the dispatcher, the
+    outbox and the presence mirror without a real Murmur.
+
+    Usage: python -m bench.bench_ice [--servers N] [--rate MSG/S] [--seconds N]
+                                     [--state-changes FRACTION] [--ice-threads N]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+import Ice
+
+import app.murmur
+from app.dispatch import get_dispatcher
+from app.outbox import SEPARATOR
+from app.slice import Murmur
+
+# The bench measures the bot, not Murmur's rate limit
+os.environ.setdefault('OUTBOX_WINDOW', '0')
+os.environ.setdefault('OUTBOX_RATE', '1000000')
+os.environ.setdefault('OUTBOX_BURST', '1000000')
+
+SECRET = 'bench'
+
+
+class Replies:
+    """Send and reply times of every message, matched by user name"""
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def send(self, name):
+        with self._lock:
+            self.sent[name] = time.perf_counter()
+
+    def reply(self, text):
+        now = time.perf_counter()
+
+        # The outbox may merge replies to a channel into one message
+        for part in text.split(SEPARATOR):
+            name = part.split(' ', 1)[0]
+            with self._lock:
+                sent = self.sent.pop(name, None)
+                if sent is None:
+                    self.unmatched += 1
+                else:
+                    self.latencies.append(now - sent)
+
+
+class FakeServer(Murmur.Server):
+    """Just enough of a virtual server for the bot to mirror and reply to"""
+    def __init__(self, id, replies):
+        super().__init__()
+        self._id = id
+        self.replies = replies
+        self.callbacks = []
+        self.users = {}
+
+    def id(self, current=None):
+        return self._id
+
+    def isRunning(self, current=None):
+        return True
+
+    def getConf(self, key, current=None):
+        return '{}-{}'.format(key, self._id)
+
+    def getUptime(self, current=None):
+        return 0
+
+    def getUsers(self, current=None):
+        return self.users
+
+    def getChannels(self, current=None):
+        return {0: Murmur.Channel(id=0, name='Root', parent=-1)}
+
+    def addCallback(self, cb, current=None):
+        self.callbacks.append(cb)
+
+    def removeCallback(self, cb, current=None):
+        self.callbacks.remove(cb)
+
+    def sendMessageChannel(self, channel, tree, text, current=None):
+        self.replies.reply(text)
+
+    def sendMessage(self, session, text, current=None):
+        self.replies.reply(text)
+
+
+class FakeMeta(Murmur.Meta):
+    def __init__(self, servers):
+        super().__init__()
+        self.servers = servers
+        self.callbacks = []
+
+    def getAllServers(self, current=None):
+        return self.servers
+
+    def getBootedServers(self, current=None):
+        return self.servers
+
+    def addCallback(self, cb, current=None):
+        self.callbacks.append(cb)
+
+    def removeCallback(self, cb, current=None):
+        self.callbacks.remove(cb)
+
+    def getUptime(self, current=None):
+        return 0
+
+
+def start_murmur(count, replies):
+    """Serve a fake Meta with `count` booted virtual servers
+
+    :return: (communicator, port, list of FakeServer)
+    """
+    props = Ice.createProperties()
+    props.setProperty('Ice.Default.EncodingVersion', '1.0')
+    props.setProperty('Ice.MessageSizeMax', '65535')
+    props.setProperty('Ice.ThreadPool.Server.Size', '4')
+    props.setProperty('Ice.ThreadPool.Server.SizeMax', '4')
+
+    idd = Ice.InitializationData()
+    idd.properties = props
+    comm = Ice.initialize(idd)
+
+    adapter = comm.createObjectAdapterWithEndpoints('Murmur', 'tcp -h 127.0.0.1')
+
+    servants = []
+    proxies = []
+    for id in range(1, count + 1):
+        servant = FakeServer(id, replies)
+        proxy = adapter.add(servant, Ice.stringToIdentity('s/{}'.format(id)))
+        servants.append(servant)
+        proxies.append(Murmur.ServerPrx.uncheckedCast(proxy))
+
+    adapter.add(FakeMeta(proxies), Ice.stringToIdentity('Meta'))
+    adapter.activate()
+
+    port = adapter.getEndpoints()[0].getInfo().port
+    return comm, port, servants
+
+
+def create_user(session, name):
+    user = Murmur.User()
+    user.session = session
+    user.userid = -1
+    user.name = name
+    user.channel = 0
+    user.address = [0] * 16
+
+    return user
+
+
+def fire(servants, replies, rate, seconds, state_changes):
+    """Send `rate` messages per second, round robin across servers, for `seconds`
+
+    :return: Number of text messages sent
+    """
+    tick = 0.01
+    per_tick = max(1, int(rate * tick))
+    every_state = int(1 / state_changes) if state_changes else 0
+
+    seq = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+
+    while time.perf_counter() < deadline:
+        for _ in range(per_tick):
+            servant = servants[seq % len(servants)]
+            user = create_user(seq % 1000 + 1, 'u{}'.format(seq))
+
+            if every_state and seq % every_state == 0:
+                for cb in servant.callbacks:
+                    cb.userStateChangedAsync(user)
+
+            replies.send(user.name)
+            msg = Murmur.TextMessage([], [0], [], '!1d6')
+            for cb in servant.callbacks:
+                cb.userTextMessageAsync(user, msg)
+
+            seq += 1
+
+        # Pace to the requested rate
+        ahead = started + seq / rate - time.perf_counter()
+        if ahead > 0:
+            time.sleep(ahead)
+
+    return seq
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))] if values else float('nan')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end load test against a fake Murmur')
+    parser.add_argument('--servers', type=int, default=10, help='Virtual servers to boot')
+    parser.add_argument('--rate', type=float, default=2000, help='Text messages per second')
+    parser.add_argument('--seconds', type=float, default=5, help='How long to send for')
+    parser.add_argument('--state-changes', type=float, default=0.2,
+                        help='userStateChanged callbacks sent per text message')
+    parser.add_argument('--ice-threads', help='Bot callback thread pool size (ICE_SERVER_THREADS)')
+    parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for late replies')
+    args = parser.parse_args(argv)
+
+    replies = Replies()
+    comm, port, servants = start_murmur(args.servers, replies)
+
+    os.environ.update({
+        'ICE_HOST': '127.0.0.1',
+        'ICE_PORT': str(port),
+        'ICE_SECRET': SECRET
+    })
+
+    if args.ice_threads:
+        os.environ['ICE_SERVER_THREADS'] = args.ice_threads
+
+    logger = logging.getLogger('murmur')
+    logger.setLevel(logging.WARNING)
+    app.murmur.murmur_connect(logger)
+
+    try:
+        sent = fire(servants, replies, args.rate, args.seconds, args.state_changes)
+        time.sleep(args.drain)
+
+        latencies = sorted(replies.latencies)
+        stats = get_dispatcher().stats()
+
+        print('servers       {}'.format(args.servers))
+        print('sent          {:,} ({:,.0f} msg/s)'.format(sent, sent / args.seconds))
+        print('replied       {:,} ({:.1%})'.format(len(latencies), len(latencies) / sent if sent else 0))
+        print('unmatched     {:,}'.format(replies.unmatched))
+        print('dropped       {:,} (dispatch queue full)'.format(stats['dropped']))
+        print('p50 latency   {:.2f} ms'.format(percentile(latencies, 0.5) * 1000))
+        print('p99 latency   {:.2f} ms'.format(percentile(latencies, 0.99) * 1000))
+        print('max latency   {:.2f} ms'.format(latencies[-1] * 1000 if latencies else float('nan')))
+    finally:
+        app.murmur.get_murmur_meta().ice_getCommunicator().destroy()
+        comm.destroy()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+    Micro-benchmark of command routing: the prefiltered `Router` versus a
+    linear `re.search` over every subscribed command.
+
+    Usage: python -m bench.bench_router [seconds]
+"""
+import sys
+import time
+
+from app.commands import command_subscribers, router
+
+CORPUS = {
+    # Plain chat - the overwhelming majority of traffic
+    'plain': [
+        'lol',
+        'anyone up for a game tonight?',
+        'brb getting food',
+        'that was <b>awful</b>, never again. I can\'t believe we lost that round with a 4 man stack',
+        'hi there',
+        'http is a protocol, not a website',
+    ],
+    'commands': [
+        'hi',
+        '!2d6',
+        '!pickone Gfro, Phantom, Mark',
+        '!help',
+    ],
+    'links': [
+        '<a href="https://www.youtube.com/watch?v=dQw4w9WgXcQ">https://www.youtube.com/watch?v=dQw4w9WgXcQ</a>',
+        '<a href="https://store.steampowered.com/app/440/">https://store.steampowered.com/app/440/</a>',
+        '<a href="https://steamcommunity.com/sharedfiles/filedetails/?id=123456">link</a>',
+        '<a href="https://www.reddit.com/r/games">https://www.reddit.com/r/games</a>',
+    ]
+}
+
+
+def linear_match(text):
+    """Routing as it was done before the Router: try every pattern in order"""
+    for command in command_subscribers:
+        match = command['prog'].search(text)
+        if match:
+            return command, match
+
+    return None, None
+
+
+def run(match, messages, seconds):
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for text in messages:
+            match(text)
+        count += len(messages)
+
+    return count / seconds
+
+
+def main(seconds=2.0):
+    print('{} commands subscribed'.format(len(command_subscribers)))
+    print('{:<10} {:>14} {:>14} {:>8}'.format('corpus', 'linear msg/s', 'router msg/s', 'speedup'))
+
+    for name, messages in CORPUS.items():
+        # Sanity check that both strategies route identically
+        for text in messages:
+            a, _ = linear_match(text)
+            b, _ = router.match(text)
+            assert a is b, 'Routing mismatch for {!r}'.format(text)
+
+        linear = run(linear_match, messages, seconds)
+        routed = run(router.match, messages, seconds)
+
+        print('{:<10} {:>14,.0f} {:>14,.0f} {:>7.1f}x'.format(name, linear, routed, routed / linear))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0)
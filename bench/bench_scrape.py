@@ -0,0 +1,120 @@
+"""
+    Benchmark of Steam page scraping: the previous full BeautifulSoup parse
+    versus the incremental `app.scrape` extraction, over the saved page
+    fixtures in test/fixtures.
+
+    Fixtures are trimmed down copies of real pages, so their body is
+    repeated to bring them up to a realistic size before timing.
+
+    Usage: python -m bench.bench_scrape [page size in KiB]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from app.steam import scrape_reviews, scrape_workshop_item
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'test', 'fixtures')
+
+CHUNK_SIZE = 16 * 1024
+
+
+def load_page(name, size):
+    """Load a fixture, repeating its body until the page is `size` bytes"""
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        content = f.read()
+
+    start = content.index(b'<!-- page body -->')
+    end = content.index(b'<!-- /page body -->')
+    body = content[start:end]
+
+    repeat = max(1, (size - len(content)) // len(body))
+    return content[:start] + body * repeat + content[end:]
+
+
+def chunked(content):
+    return [content[i:i + CHUNK_SIZE] for i in range(0, len(content), CHUNK_SIZE)]
+
+
+def soup_reviews(content):
+    """Review scraping as done before `app.scrape`"""
+    reviews = []
+    soup = BeautifulSoup(content, features='html.parser')
+
+    for subtitle in soup.select('div.subtitle'):
+        for caption in subtitle.stripped_strings:
+            if caption == 'Recent Reviews:' or caption == 'All Reviews:':
+                summary = subtitle.parent.select('span.game_review_summary')
+                count = subtitle.parent.select('span.responsive_hidden')
+
+                if summary and count:
+                    reviews.append({
+                        'type': caption[:-1],
+                        'summary': summary[0].get_text(strip=True),
+                        'count': count[0].get_text(strip=True)[1:-1]
+                    })
+
+    return reviews
+
+
+def soup_workshop_item(content):
+    """Workshop scraping as done before `app.scrape`"""
+    soup = BeautifulSoup(content, features='html.parser')
+
+    return {
+        'appname': soup.select_one('.apphub_AppName').text,
+        'title': soup.select_one('.workshopItemTitle').text,
+        'logo': soup.select_one('link[rel="image_src"]')['href'],
+        'tags': [tag.text.split(':\xa0') for tag in soup.select('div.workshopTags')]
+    }
+
+
+def measure(func, arg, runs):
+    """Return (mean seconds, peak traced bytes) for `func(arg)`"""
+    tracemalloc.start()
+    func(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        func(arg)
+
+    return (time.perf_counter() - started) / runs, peak
+
+
+def main(size_kib=800, runs=5):
+    cases = [
+        ('store reviews', 'steam_store.html', soup_reviews, scrape_reviews),
+        ('workshop item', 'steam_workshop.html', soup_workshop_item, scrape_workshop_item)
+    ]
+
+    print('{:<14} {:>9} {:>12} {:>12} {:>12} {:>12}'.format(
+        'page', 'size', 'soup ms', 'stream ms', 'soup peak', 'stream peak'
+    ))
+
+    for name, fixture, soup, streaming in cases:
+        content = load_page(fixture, size_kib * 1024)
+        chunks = chunked(content)
+
+        # Sanity check that both approaches extract the same thing
+        assert soup(content) == streaming(chunks), 'Mismatch for {}'.format(name)
+
+        soup_time, soup_peak = measure(soup, content, runs)
+        stream_time, stream_peak = measure(streaming, chunks, runs)
+
+        print('{:<14} {:>6} KiB {:>12.2f} {:>12.2f} {:>8} KiB {:>8} KiB'.format(
+            name,
+            len(content) // 1024,
+            soup_time * 1000,
+            stream_time * 1000,
+            soup_peak // 1024,
+            stream_peak // 1024
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 800)
@@ -0,0 +1,28 @@
+"""
+    Fakes shared by the test cases.
+"""
+from concurrent.futures import Future
+
+
+class FakeClock:
+    """Monotonic time source that only moves when `now` is set"""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def resolved(result=None, exception=None) -> Future:
+    """Future that has already completed, like an answered Ice call
+
+    :param result: Value the future resolves to
+    :param exception: Exception to fail it with instead
+    """
+    future = Future()
+    if exception:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+    return future
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+
+from app.broadcast import Template, broadcast
+
+class MockServer:
+    def __init__(self, respond=True, exception=None):
+        self.respond = respond
+        self.exception = exception
+        self.sent = []
+
+    def sendMessageChannelAsync(self, channel, tree, text):
+        self.sent.append((channel, tree, text))
+
+        future = Future()
+        if self.exception:
+            future.set_exception(self.exception)
+        elif self.respond:
+            future.set_result(None)
+
+        return future
+
+
+class BroadcastTestCase(unittest.TestCase):
+    def test_template_reload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'notice.html')
+            with open(path, 'w') as f:
+                f.write('first\n')
+
+            template = Template(path)
+            self.assertEqual(template.render(), 'first')
+
+            with open(path, 'w') as f:
+                f.write('second\n')
+            os.utime(path, ns=(0, 1))
+
+            self.assertEqual(template.render(), 'second')
+
+    def test_broadcast_reports_each_server(self):
+        ok = MockServer()
+        slow = MockServer(respond=False)
+        failed = MockServer(exception=RuntimeError('down'))
+
+        results = broadcast([(1, ok), (2, slow), (3, failed)], 'Live', timeout=0.05)
+
+        self.assertEqual(ok.sent, [(0, True, 'Live')])
+        self.assertEqual([r['server'] for r in results], [1, 2, 3])
+        self.assertEqual([r['ok'] for r in results], [True, False, False])
+        self.assertEqual(results[2]['error'], 'RuntimeError')
+        self.assertLess(results[0]['ms'], results[1]['ms'])
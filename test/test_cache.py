@@ -0,0 +1,263 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from app import deadline
+from app.cache import PreviewCache, TextureCache, sizeof
+from app.diskcache import SCHEMA, DiskCache
+from helpers import FakeClock
+
+class PreviewCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_ttl(self):
+        cache = PreviewCache(ttls={'title': 10}, clock=self.clock)
+        cache.set('title', 'a', 'Title')
+
+        self.clock.now = 9
+        self.assertEqual(cache.get('title', 'a'), 'Title')
+
+        self.clock.now = 11
+        self.assertIsNone(cache.get('title', 'a'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['providers']['title']['hits'], 1)
+        self.assertEqual(stats['providers']['title']['misses'], 1)
+
+    def test_lru_eviction(self):
+        value = 'x' * 100
+        cache = PreviewCache(max_bytes=sizeof(value) * 2, clock=self.clock)
+
+        cache.set('title', 'a', value)
+        cache.set('title', 'b', value)
+        cache.get('title', 'a')
+        cache.set('title', 'c', value)
+
+        # b was least recently used
+        self.assertIsNone(cache.get('title', 'b'))
+        self.assertEqual(cache.get('title', 'a'), value)
+        self.assertEqual(cache.get('title', 'c'), value)
+
+    def test_get_or_load(self):
+        cache = PreviewCache(clock=self.clock)
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return {'name': 'App'}
+
+        cache.get_or_load('steam_app', '1', loader)
+        value = cache.get_or_load('steam_app', '1', loader)
+
+        self.assertEqual(value, {'name': 'App'})
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrent_loads_shared(self):
+        cache = PreviewCache(clock=self.clock)
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            release.wait(5)
+            if len(calls) == 1:
+                raise ValueError('Upstream failed')
+            return 'Title'
+
+        def load():
+            try:
+                return cache.get_or_load('title', 'a', loader)
+            except ValueError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [executor.submit(load) for _ in range(5)]
+            while cache.stats()['providers'].get('title', {}).get('shared', 0) < 4:
+                time.sleep(0.001)
+            release.set()
+            results = [f.result() for f in futures]
+
+        # One upstream call, whose failure every waiter sees (each with
+        # an exception of its own)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(len(set(map(id, results))), 5)
+
+        # The failure is remembered for a while (as a new exception each
+        # time), then the next load tries again
+        with self.assertRaises(ValueError) as first:
+            cache.get_or_load('title', 'a', loader)
+        with self.assertRaises(ValueError) as second:
+            cache.get_or_load('title', 'a', loader)
+        self.assertIsNot(first.exception, second.exception)
+        self.assertEqual(second.exception.args, ('Upstream failed',))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['providers']['title']['errors'], 2)
+
+        self.clock.now = cache.error_ttl + 1
+        self.assertEqual(cache.get_or_load('title', 'a', loader), 'Title')
+        self.assertEqual(len(calls), 2)
+
+    def test_waiter_outlives_leader_deadline(self):
+        cache = PreviewCache(clock=self.clock)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                release.wait(5)
+                deadline.check('Loading')
+            return 'Title'
+
+        def lead():
+            with deadline.deadline(0.05):
+                cache.get_or_load('title', 'a', loader)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(lead)
+            started.wait(5)
+
+            # Without a deadline, like the refresher
+            waiter = executor.submit(cache.get_or_load, 'title', 'a', loader)
+            while cache.stats()['providers'].get('title', {}).get('shared', 0) < 1:
+                time.sleep(0.001)
+
+            time.sleep(0.06)
+            release.set()
+
+            with self.assertRaises(deadline.DeadlineExceeded):
+                leader.result()
+            self.assertEqual(waiter.result(), 'Title')
+
+        self.assertEqual(len(calls), 2)
+
+
+class TextureCacheTestCase(unittest.TestCase):
+    def test_invalidate(self):
+        cache = TextureCache()
+        loads = []
+        encodes = []
+
+        def load():
+            loads.append(1)
+            return b'texture'
+
+        def encode(texture):
+            encodes.append(1)
+            return 'data:' + texture.decode()
+
+        self.assertEqual(cache.get(1, 5, load, encode), 'data:texture')
+        self.assertEqual(cache.get(1, 5, load, encode), 'data:texture')
+        self.assertEqual((len(loads), len(encodes)), (1, 1))
+
+        # Rechecked after a state change, but the same texture isn't re-encoded
+        cache.invalidate(1, 5)
+        self.assertEqual(cache.get(1, 5, load, encode), 'data:texture')
+        self.assertEqual((len(loads), len(encodes)), (2, 1))
+
+    def test_invalidate_during_load(self):
+        cache = TextureCache()
+        textures = [b'old', b'new']
+
+        def load():
+            texture = textures.pop(0)
+            if texture == b'old':
+                # The avatar changes while Murmur's answer is on its way
+                cache.invalidate(1, 5)
+            return texture
+
+        self.assertEqual(cache.get(1, 5, load, bytes.decode), 'old')
+        self.assertEqual(cache.get(1, 5, load, bytes.decode), 'new')
+        self.assertEqual(cache.get(1, 5, load, bytes.decode), 'new')
+
+    def test_remove(self):
+        cache = TextureCache()
+        for server_id, userid in ((1, 5), (1, 6), (2, 5)):
+            cache.get(server_id, userid, lambda: b'texture', bytes.decode)
+
+        cache.remove(1, 5)
+        cache.remove_server(2)
+        self.assertEqual(list(cache._entries), [(1, 6)])
+        self.assertEqual(list(cache._generations), [(1, 6)])
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'previews.sqlite3')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_survives_restart(self):
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return {'name': 'App', 'tags': [['Type', 'Map']]}
+
+        first = PreviewCache(disk=DiskCache(self.path))
+        first.get_or_load('steam_app', '1', loader)
+
+        # A new process with a cold memory tier
+        second = PreviewCache(disk=DiskCache(self.path))
+        value = second.get_or_load('steam_app', '1', loader)
+
+        self.assertEqual(value, {'name': 'App', 'tags': [['Type', 'Map']]})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(second.stats()['providers']['steam_app']['disk_hits'], 1)
+
+    def test_expiry_and_compaction(self):
+        disk = DiskCache(self.path, max_bytes=1024, clock=self.clock)
+        disk.set('title', 'old', 'Old', ttl=10)
+        disk.set('title', 'new', 'New', ttl=100)
+
+        self.clock.now = 11
+        self.assertIsNone(disk.get('title', 'old'))
+        self.assertEqual(disk.get('title', 'new'), ('New', 89))
+
+        self.assertEqual(disk.compact(), 1)
+        self.assertEqual(disk.stats()['entries'], 1)
+
+        # Over budget - the soonest to expire go first
+        for i in range(200):
+            disk.set('image', str(i), os.urandom(64).hex(), ttl=1000 + i)
+
+        disk.compact()
+        self.assertLessEqual(disk.stats()['bytes'], 1024)
+        self.assertIsNotNone(disk.get('image', '199'))
+
+    def test_compaction_shrinks_file(self):
+        disk = DiskCache(self.path, clock=self.clock)
+        self.assertEqual(disk._db().execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+        for i in range(500):
+            disk.set('image', str(i), os.urandom(1024).hex(), ttl=10)
+        disk.compact()
+        full = os.path.getsize(self.path)
+
+        self.clock.now = 11
+        self.assertEqual(disk.compact(), 500)
+        self.assertLess(os.path.getsize(self.path), full / 10)
+
+    def test_old_file_converted(self):
+        # Created the way this used to: WAL first, so no auto_vacuum
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute(SCHEMA)
+        db.commit()
+        db.close()
+
+        disk = DiskCache(self.path)
+        self.assertEqual(disk._db().execute('PRAGMA auto_vacuum').fetchone()[0], 2)
@@ -1,13 +1,25 @@
 
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
+
+from requests import ConnectionError
 
 import app.commands as cmds
-import Murmur
+from app import deadline
+from app.dispatch import Dispatcher
+from app.router import Router
+from app.slice import Murmur
 
 class MockServer(Murmur.Server):
     def sendMessageChannel(self, channel, tree, text):
         self.text = text
+        self.sent = getattr(self, 'sent', 0) + 1
 
     def sendMessage(self, session, text):
         self.text = text
@@ -38,5 +50,136 @@ class CommandsTestCase(unittest.TestCase):
 
         self.assertTrue(len(server.text) > 0)
 
+    def test_dispatched(self):
+        server = MockServer()
+        user = create_mock_user()
+        dispatcher = Dispatcher(workers=1, queue_size=1)
+
+        text = create_mock_text('hi')
+        cmds.publish(server, user, text, dispatcher)
+        dispatcher.shutdown()
+
+        self.assertTrue(len(server.text) > 0)
+        self.assertEqual(dispatcher.stats()['commands']['hello']['count'], 1)
+
+    def test_lanes(self):
+        server = MockServer()
+        user = create_mock_user()
+        dispatcher = Dispatcher(workers=1, queue_size=1)
+        release = threading.Event()
+
+        # Fill the I/O lane with previews that can't finish
+        with patch('app.plugins.video.get_url_title', side_effect=lambda url: release.wait(5) and 'Title'), \
+                patch('app.plugins.video.image_url_to_data_uri', return_value=None):
+            text = create_mock_text('<a href="https://youtu.be/aaaaaaaaaaa">https://youtu.be/aaaaaaaaaaa</a>')
+            for _ in range(3):
+                cmds.publish(server, user, text, dispatcher)
+
+            # A dice roll still goes straight through
+            replied = threading.Event()
+            server.sendMessageChannel = lambda channel, tree, text: replied.set()
+            cmds.publish(server, user, create_mock_text('!2d6'), dispatcher)
+            self.assertTrue(replied.wait(5))
+
+            release.set()
+            dispatcher.shutdown()
+
+        lanes = dispatcher.stats()['lanes']
+        self.assertEqual(lanes['io']['dropped'], 1)
+        self.assertEqual(lanes['interactive']['dropped'], 0)
+
+    def test_plain_text_ignored(self):
+        server = MockServer()
+        user = create_mock_user()
+
+        text = create_mock_text('hi everyone, check out youtube later')
+        cmds.publish(server, user, text)
+
+        self.assertFalse(hasattr(server, 'text'))
+
+    def test_router_prefilter(self):
+        command, match = cmds.router.match('!3D6')
+        self.assertEqual(command['func'].__name__, 'roll')
+        self.assertEqual(match.group('dice'), '3')
+
+        command, match = cmds.router.match('HELLO')
+        self.assertEqual(command['func'].__name__, 'hello')
 
+    def test_router_checks_remaining_prefix(self):
+        router = Router()
+        router.add({'prog': re.compile('ok', re.IGNORECASE), 'prefix': ('!ok',)})
+        router.add({'prog': re.compile('.'), 'keywords': ('x',)})
+
+        # Same first character as the prefix, but not the whole prefix
+        self.assertIsNone(router.match('!no ok')[0])
+        self.assertIs(router.match('!OK')[0], router.commands[0])
+        self.assertIs(router.match('!no x')[0], router.commands[1])
+
+    @patch('app.plugins.video.image_url_to_data_uri', return_value='data:')
+    @patch('app.plugins.video.get_url_title', side_effect=lambda url: url[-11:] + ' - YouTube')
+    def test_previews_merged(self, get_url_title, image_url_to_data_uri):
+        server = MockServer()
+        user = create_mock_user()
+
+        text = create_mock_text(
+            '<a href="https://www.youtube.com/watch?v=aaaaaaaaaaa">https://www.youtube.com/watch?v=aaaaaaaaaaa</a> '
+            'vs <a href="https://youtu.be/bbbbbbbbbbb">https://youtu.be/bbbbbbbbbbb</a>'
+        )
+        cmds.publish(server, user, text)
+
+        # One reply containing both links, each fetched once
+        self.assertEqual(server.sent, 1)
+        self.assertEqual(get_url_title.call_count, 2)
+        self.assertIn('<b>aaaaaaaaaaa</b>', server.text)
+        self.assertIn('<b>bbbbbbbbbbb</b>', server.text)
+        self.assertIn('href="https://youtu.be/bbbbbbbbbbb"', server.text)
+
+    @patch('app.plugins.video.get_url_title', side_effect=ConnectionError('down'))
+    def test_preview_degrades_to_link(self, get_url_title):
+        server = MockServer()
+        user = create_mock_user()
+
+        text = create_mock_text('<a href="https://youtu.be/aaaaaaaaaaa">https://youtu.be/aaaaaaaaaaa</a>')
+        cmds.publish(server, user, text)
+
+        self.assertEqual(
+            server.text,
+            'Mock posted a link to <a href="https://youtu.be/aaaaaaaaaaa">https://youtu.be/aaaaaaaaaaa</a>'
+        )
+
+    @patch('app.plugins.video.get_url_title', return_value='Video - YouTube')
+    def test_preview_partial_at_deadline(self, get_url_title):
+        def slow_thumbnail(url):
+            # Fetches give up once the deadline has passed
+            time.sleep(0.2)
+            deadline.check(url)
+            return 'data:'
+
+        server = MockServer()
+        user = create_mock_user()
+        text = create_mock_text('<a href="https://youtu.be/aaaaaaaaaaa">https://youtu.be/aaaaaaaaaaa</a>')
+
+        with patch('app.plugins.video.image_url_to_data_uri', side_effect=slow_thumbnail), \
+                patch.dict(cmds.router.match(text.text)[0], budget=0.1):
+            cmds.publish(server, user, text)
+
+        # Title without the thumbnail
+        self.assertIn('<b>Video</b>', server.text)
+        self.assertNotIn('<img', server.text)
+
+    def test_plugins_loaded_lazily(self):
+        # Needs a fresh interpreter, as other tests have run the plugins
+        code = (
+            'import sys, app.commands as c; '
+            'print(sorted(m for m in ("app.plugins.video", "app.steam", "PIL") if m in sys.modules)); '
+            'print(c.router.match("https://youtu.be/aaaaaaaaaaa")[0]["func"].__name__)'
+        )
+        out = subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+            stdout=subprocess.PIPE,
+            check=True
+        ).stdout.decode().split()
+
+        self.assertEqual(out, ['[]', 'youtube'])
 
@@ -0,0 +1,35 @@
+import time
+import unittest
+
+from app import deadline
+from app.fetch import submit
+
+class DeadlineTestCase(unittest.TestCase):
+    def test_nesting(self):
+        self.assertIsNone(deadline.remaining())
+
+        with deadline.deadline(10):
+            self.assertAlmostEqual(deadline.remaining(), 10, delta=0.5)
+
+            # The outer deadline is sooner, so it still applies
+            with deadline.deadline(100):
+                self.assertAlmostEqual(deadline.remaining(), 10, delta=0.5)
+
+            with deadline.deadline(1):
+                self.assertAlmostEqual(deadline.remaining(), 1, delta=0.5)
+
+        self.assertIsNone(deadline.remaining())
+
+    def test_check(self):
+        with deadline.deadline(at=time.monotonic() - 1):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                deadline.check()
+
+        deadline.check()
+
+    def test_carried_to_fetch_pool(self):
+        with deadline.deadline(5):
+            left = submit(deadline.remaining).result()
+
+        self.assertAlmostEqual(left, 5, delta=0.5)
+        self.assertIsNone(submit(deadline.remaining).result())
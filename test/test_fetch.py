@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app import deadline, fetch
+from app.util import get_url_title
+from helpers import FakeClock
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/error':
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path == '/stall':
+            # Headers and a little of the body, then nothing
+            self.send_response(200)
+            self.send_header('Content-Length', '1024')
+            self.end_headers()
+            self.wfile.write(b'x' * 16)
+            self.wfile.flush()
+            time.sleep(1)
+            return
+
+        if self.path == '/page':
+            body = b'<html><head><title>Stub - YouTube</title></head>' + b'x' * 1024 * 1024
+        else:
+            body = b'x' * int(self.path[1:])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early (e.g. title streaming) is expected
+        pass
+
+
+class FetchTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(('127.0.0.1', 0), StubHandler)
+        cls.url = 'http://127.0.0.1:{}/'.format(cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch(self):
+        r = fetch.fetch(self.url + '100')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'x' * 100)
+        self.assertEqual(r.text, 'x' * 100)
+        self.assertGreaterEqual(fetch.stats()['127.0.0.1']['count'], 1)
+
+    def test_max_bytes(self):
+        with self.assertRaises(fetch.ResponseTooLarge):
+            fetch.fetch(self.url + '2048', max_bytes=1024)
+
+    def test_stream_max_bytes(self):
+        chunks = list(fetch.stream(self.url + '4096', max_bytes=1000, chunk_size=256))
+        self.assertEqual(len(b''.join(chunks)), 1000)
+
+    def test_connection_wait_bounded_by_deadline(self):
+        busy = threading.BoundedSemaphore(1)
+        busy.acquire()
+
+        with patch.dict(fetch._slots, {'127.0.0.1': busy}), deadline.deadline(0.05):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                fetch.fetch(self.url + '100')
+
+    def test_stalled_body_at_deadline(self):
+        breaker = fetch.CircuitBreaker(failures=2)
+
+        with patch.dict(fetch._breakers, {'127.0.0.1': breaker}):
+            for _ in range(3):
+                with deadline.deadline(0.1), self.assertRaises(deadline.DeadlineExceeded):
+                    fetch.fetch(self.url + 'stall')
+
+            with deadline.deadline(0.1), self.assertRaises(deadline.DeadlineExceeded):
+                list(fetch.stream(self.url + 'stall'))
+
+            # Running out of our own time isn't the host's fault
+            self.assertEqual(breaker.state, fetch.CircuitBreaker.CLOSED)
+
+    def test_get_url_title(self):
+        self.assertEqual(get_url_title(self.url + 'page'), 'Stub - YouTube')
+
+    def test_circuit_breaker(self):
+        clock = FakeClock()
+        breaker = fetch.CircuitBreaker(failures=2, reset=30, clock=clock)
+
+        with patch.dict(fetch._breakers, {'127.0.0.1': breaker}):
+            for _ in range(2):
+                fetch.fetch(self.url + 'error')
+
+            # Open - refused without a request
+            with self.assertRaises(fetch.CircuitOpen):
+                fetch.fetch(self.url + '100')
+
+            # Half-open - a failed probe opens it again
+            clock.now = 30
+            fetch.fetch(self.url + 'error')
+            self.assertEqual(breaker.state, fetch.CircuitBreaker.OPEN)
+            with self.assertRaises(fetch.CircuitOpen):
+                fetch.fetch(self.url + '100')
+
+            # A successful probe closes it
+            clock.now = 60
+            self.assertEqual(fetch.fetch(self.url + '100').status_code, 200)
+            self.assertEqual(breaker.state, fetch.CircuitBreaker.CLOSED)
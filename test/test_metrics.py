@@ -0,0 +1,41 @@
+import unittest
+from concurrent.futures import Future
+
+from app.metrics import Registry
+from app import metrics
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'Things', ('kind',))
+        histogram = registry.histogram('test_seconds', 'Time', ('kind',), buckets=(0.1, 1))
+
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(5, 'a')
+
+        registry.collector(lambda: [('test_gauge', 'gauge', 'Level', [({'x': 'q"'}, 7)])])
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{kind="a"} 3', lines)
+        self.assertIn('test_seconds_bucket{kind="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{kind="a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{kind="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_sum{kind="a"} 5.55', lines)
+        self.assertIn('test_seconds_count{kind="a"} 3', lines)
+        self.assertIn('test_gauge{x="q\\""} 7', lines)
+
+    def test_ice_future(self):
+        before = metrics.ice_seconds.count('test')
+        failures = metrics.ice_failures.value('test')
+
+        ok = metrics.ice_future('test', Future())
+        failed = metrics.ice_future('test', Future())
+        ok.set_result(None)
+        failed.set_exception(RuntimeError())
+
+        self.assertEqual(metrics.ice_seconds.count('test'), before + 2)
+        self.assertEqual(metrics.ice_failures.value('test'), failures + 1)
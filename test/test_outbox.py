@@ -0,0 +1,100 @@
+import unittest
+
+from app.outbox import Outbox
+from helpers import FakeClock, resolved
+
+class MockServer:
+    def __init__(self):
+        self.sent = []
+
+    def sendMessageChannelAsync(self, channel, tree, text):
+        self.sent.append((channel, text))
+        return resolved()
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.server = MockServer()
+
+    def test_coalesces_within_window(self):
+        outbox = Outbox(window=1, clock=self.clock)
+        outbox.send(self.server, 0, 'a')
+        outbox.send(self.server, 0, 'b')
+        outbox.send(self.server, 1, 'c')
+
+        self.assertEqual(outbox.flush(), 1)
+        self.assertEqual(self.server.sent, [])
+
+        self.clock.now = 1
+        self.assertIsNone(outbox.flush())
+        self.assertEqual(self.server.sent, [(0, 'a<br/><br/>b'), (1, 'c')])
+        self.assertEqual(outbox.stats()['sent'], 2)
+
+    def test_rate_limit(self):
+        outbox = Outbox(window=0, rate=1, burst=2, clock=self.clock)
+
+        for text in ('a', 'b', 'c'):
+            outbox.send(self.server, 0, text)
+            outbox.flush()
+
+        # Burst spent - the third reply waits for a token
+        self.assertEqual([t for _, t in self.server.sent], ['a', 'b'])
+
+        outbox.send(self.server, 0, 'd')
+        self.clock.now = 0.5
+        self.assertAlmostEqual(outbox.flush(), 0.5)
+
+        self.clock.now = 1
+        outbox.flush()
+        self.assertEqual([t for _, t in self.server.sent], ['a', 'b', 'c<br/><br/>d'])
+
+    def test_urgent_skips_window_and_queue(self):
+        outbox = Outbox(window=1, rate=1, burst=2, clock=self.clock)
+
+        # Previews to three channels, only two of which fit the burst
+        for channel in (1, 2, 3):
+            outbox.send(self.server, channel, 'preview {}'.format(channel))
+        self.clock.now = 1
+        outbox.flush()
+
+        # No waiting on the window, but no extra tokens either
+        outbox.send(self.server, 0, 'roll', urgent=True)
+        self.assertAlmostEqual(outbox.flush(), 1)
+        self.assertEqual(len(self.server.sent), 2)
+
+        # The next token goes to the roll, ahead of the waiting preview
+        self.clock.now = 2
+        outbox.flush()
+        self.assertEqual(self.server.sent[2], (0, 'roll'))
+
+        self.clock.now = 3
+        outbox.flush()
+        self.assertEqual(self.server.sent[3], (3, 'preview 3'))
+
+    def test_urgent_within_server_limit(self):
+        outbox = Outbox(clock=self.clock)
+        for channel in range(10):
+            outbox.send(self.server, channel, 'preview')
+            outbox.send(self.server, channel, 'roll', urgent=True)
+
+        self.clock.now = 1
+        outbox.flush()
+        self.assertEqual(len(self.server.sent), 5)
+        self.assertEqual(set(text for _, text in self.server.sent), {'roll'})
+
+    def test_split_oversized(self):
+        outbox = Outbox(window=0, max_bytes=10, clock=self.clock)
+        outbox.send(self.server, 0, 'x' * 6)
+        outbox.send(self.server, 0, 'y' * 6)
+        outbox.flush()
+
+        self.assertEqual([t for _, t in self.server.sent], ['x' * 6, 'y' * 6])
+
+    def test_background_thread(self):
+        outbox = Outbox(window=0.01)
+        outbox.start()
+        outbox.send(self.server, 0, 'a')
+        outbox.stop(timeout=1)
+
+        self.assertEqual(self.server.sent, [(0, 'a')])
@@ -0,0 +1,148 @@
+import unittest
+
+from app.presence import PresenceStore
+from app.slice import Murmur
+from helpers import resolved
+
+class MockServer:
+    """Answers the asynchronous Ice calls used by PresenceStore"""
+    def __init__(self, id, running=True, users=None):
+        self._id = id
+        self.running = running
+        self.users = users or {}
+        self.calls = 0
+
+    def id(self):
+        return self._id
+
+    def idAsync(self):
+        self.calls += 1
+        return resolved(self._id)
+
+    def getConfAsync(self, key):
+        self.calls += 1
+        return resolved('{}-{}'.format(key, self._id))
+
+    def isRunningAsync(self):
+        self.calls += 1
+        return resolved(self.running)
+
+    def _booted(self, result):
+        self.calls += 1
+        if not self.running:
+            return resolved(exception=Murmur.ServerBootedException())
+
+        return resolved(result)
+
+    def getUptimeAsync(self):
+        return self._booted(100)
+
+    def getUsersAsync(self):
+        return self._booted(self.users)
+
+    def getChannelsAsync(self):
+        return self._booted({0: Murmur.Channel(id=0, name='Root')})
+
+
+class MockMeta:
+    def __init__(self, servers):
+        self.servers = servers
+
+    def getAllServers(self):
+        return self.servers
+
+
+def create_user(session, name):
+    return Murmur.User(session=session, userid=-1, name=name)
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+    def test_events_update_snapshot(self):
+        server = MockServer(1, users={1: create_user(1, 'Mock')})
+        store = PresenceStore()
+        store.reconcile(MockMeta([server]))
+        calls = server.calls
+
+        store.user_connected(1, create_user(2, 'Other'))
+        store.user_state_changed(1, create_user(1, 'Renamed'))
+        store.user_disconnected(1, create_user(2, 'Other'))
+
+        users = store.users()
+        self.assertEqual(len(users), 1)
+        self.assertEqual(users[0][2].name, 'Renamed')
+
+        servers = store.servers()
+        self.assertEqual(servers[0]['name'], 'registername-1')
+        self.assertEqual(servers[0]['users'], 1)
+        self.assertGreaterEqual(servers[0]['uptime'], 100)
+
+        # Reads never go back to Murmur
+        self.assertEqual(server.calls, calls)
+
+    def test_reconcile_repairs_drift(self):
+        server = MockServer(1, users={1: create_user(1, 'Mock')})
+        gone = MockServer(2)
+        store = PresenceStore()
+        store.reconcile(MockMeta([server, gone]))
+
+        # A missed disconnect and a removed server
+        server.users = {}
+        store.reconcile(MockMeta([server]))
+
+        self.assertEqual(store.users(), [])
+        self.assertEqual([s['id'] for s in store.servers()], [1])
+
+    def test_event_during_reconcile(self):
+        server = MockServer(1, users={1: create_user(1, 'Mock')})
+        store = PresenceStore()
+        store.reconcile(MockMeta([server]))
+
+        # Murmur answers with who was on, then the callbacks for a
+        # connect and a disconnect land before the snapshot is swapped in
+        get_users = server.getUsersAsync
+        def getUsersAsync():
+            future = get_users()
+            store.user_connected(1, create_user(2, 'Other'))
+            store.user_disconnected(1, create_user(1, 'Mock'))
+            return future
+
+        server.getUsersAsync = getUsersAsync
+        store.reconcile(MockMeta([server]))
+
+        self.assertEqual([user.name for _, _, user in store.users()], ['Other'])
+        self.assertEqual(store._journals, [])
+
+    def test_event_during_seed(self):
+        server = MockServer(1, users={1: create_user(1, 'Mock')})
+        store = PresenceStore()
+
+        # Someone reconnects as soon as the server has started
+        get_users = server.getUsersAsync
+        def getUsersAsync():
+            future = get_users()
+            store.user_connected(1, create_user(2, 'Other'))
+            return future
+
+        server.getUsersAsync = getUsersAsync
+        store.seed(server)
+
+        self.assertEqual([user.name for _, _, user in store.users()], ['Mock', 'Other'])
+        self.assertEqual(store._journals, [])
+
+    def test_stopped_server_is_mirrored(self):
+        store = PresenceStore()
+        store.reconcile(MockMeta([MockServer(1, running=False)]))
+
+        servers = store.servers()
+        self.assertFalse(servers[0]['isRunning'])
+        self.assertEqual(servers[0]['users'], 0)
+
+    def test_stopped_server(self):
+        store = PresenceStore()
+        store.seed(MockServer(1, users={1: create_user(1, 'Mock')}))
+        store.server_stopped(1)
+
+        servers = store.servers()
+        self.assertFalse(servers[0]['isRunning'])
+        self.assertEqual(servers[0]['uptime'], 0)
+        self.assertEqual(store.users(), [])
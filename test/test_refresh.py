@@ -0,0 +1,102 @@
+import unittest
+
+from app.cache import PreviewCache
+from app.refresh import Refresher
+from helpers import FakeClock
+
+class RefresherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = PreviewCache(
+            ttls={'steam_app': 100},
+            stale_ttls={'steam_app': 1000},
+            clock=self.clock
+        )
+        self.cache.refresher = Refresher(self.cache)
+        self.prices = {}
+
+    def loader(self, appid):
+        def load():
+            price = self.prices[appid]
+            if isinstance(price, Exception):
+                raise price
+            return {'price': price}
+        return load
+
+    def test_stale_served_while_refreshed(self):
+        self.prices['1'] = 1999
+        self.cache.get_or_load('steam_app', '1', self.loader('1'))
+
+        # Expired, so the old price comes back immediately
+        self.prices['1'] = 999
+        self.clock.now = 150
+        value = self.cache.get_or_load('steam_app', '1', self.loader('1'))
+        self.assertEqual(value, {'price': 1999})
+        self.assertEqual(self.cache.stats()['providers']['steam_app']['stale_hits'], 1)
+
+        self.assertTrue(self.cache.refresher.run_once())
+        self.assertFalse(self.cache.refresher.run_once())
+        self.assertEqual(self.cache.get('steam_app', '1'), {'price': 999})
+
+        # Past the stale TTL it's a plain miss again
+        self.clock.now = 2000
+        self.prices['1'] = 499
+        value = self.cache.get_or_load('steam_app', '1', self.loader('1'))
+        self.assertEqual(value, {'price': 499})
+
+    def test_failed_refresh_keeps_stale_value(self):
+        self.prices['1'] = 1999
+        self.cache.get_or_load('steam_app', '1', self.loader('1'))
+
+        self.prices['1'] = ValueError('Steam is down')
+        self.clock.now = 150
+        self.cache.get_or_load('steam_app', '1', self.loader('1'))
+        self.cache.refresher.run_once()
+
+        value = self.cache.get_or_load('steam_app', '1', self.loader('1'))
+        self.assertEqual(value, {'price': 1999})
+        self.assertEqual(self.cache.refresher.stats()['failed'], 1)
+
+    def test_recently_requested_refreshed_first(self):
+        for appid in ('1', '2', '3', '4'):
+            self.prices[appid] = 1999
+            self.cache.get_or_load('steam_app', appid, self.loader(appid))
+
+        # Requested again close to expiry, except 4 which nobody asked for
+        for now, appid in ((85, '2'), (90, '3'), (95, '1')):
+            self.clock.now = now
+            self.cache.get_or_load('steam_app', appid, self.loader(appid))
+
+        self.cache.refresher.recent = 20
+        self.cache.refresher.scan()
+
+        order = []
+        key = self.cache.refresher._next()
+        while key:
+            order.append(key[1])
+            key = self.cache.refresher._next()
+
+        self.assertEqual(order, ['1', '3', '2'])
+
+    def test_fresh_entries_not_refreshed(self):
+        self.prices['1'] = 1999
+        self.cache.get_or_load('steam_app', '1', self.loader('1'))
+
+        self.clock.now = 50
+        self.cache.get_or_load('steam_app', '1', self.loader('1'))
+        self.cache.refresher.scan()
+
+        self.assertEqual(self.cache.refresher.stats()['pending'], 0)
+
+    def test_short_ttl_entries_due_by_their_own_ttl(self):
+        # A partial result kept for a tenth of the provider's TTL
+        self.prices['1'] = 1999
+        self.cache.get_or_load('steam_app', '1', self.loader('1'), ttl=10)
+
+        self.clock.now = 5
+        self.cache.get_or_load('steam_app', '1', self.loader('1'), ttl=10)
+        self.assertEqual(self.cache.refresher.stats()['pending'], 0)
+
+        self.clock.now = 9
+        self.cache.get_or_load('steam_app', '1', self.loader('1'), ttl=10)
+        self.assertEqual(self.cache.refresher.stats()['pending'], 1)
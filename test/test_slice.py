@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from app.slice import MURMUR_SLICE, Murmur, cache_key, compile_slice
+
+class SliceTestCase(unittest.TestCase):
+    def test_compile_cached(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = compile_slice(MURMUR_SLICE, tmp)
+
+            self.assertEqual(os.path.basename(directory), cache_key(MURMUR_SLICE))
+            self.assertTrue(os.path.isfile(os.path.join(directory, 'Murmur_ice.py')))
+
+            # Not left private to whoever built it
+            umask = os.umask(0)
+            os.umask(umask)
+            self.assertEqual(os.stat(directory).st_mode & 0o777, 0o777 & ~umask)
+
+            # Reused rather than rebuilt
+            mtime = os.stat(directory).st_mtime_ns
+            self.assertEqual(compile_slice(MURMUR_SLICE, tmp), directory)
+            self.assertEqual(os.stat(directory).st_mtime_ns, mtime)
+            self.assertEqual(os.listdir(tmp), [os.path.basename(directory)])
+
+    def test_module_loaded(self):
+        self.assertTrue(hasattr(Murmur, 'ServerPrx'))
+
+    def test_cache_dir_searched_last(self):
+        # Nothing in the cache may shadow the app or the standard library
+        cache = os.path.dirname(os.path.dirname(Murmur.__file__))
+        self.assertGreater(sys.path.index(cache), sys.path.index(os.path.dirname(os.__file__)))
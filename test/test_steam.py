@@ -0,0 +1,92 @@
+import os
+import unittest
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
+
+import app.steam as steam
+from app import deadline
+from app.cache import preview_cache
+from helpers import resolved
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def load_fixture(name, chunk_size=512):
+    """Read a saved page as a list of chunks, like `app.fetch.stream`"""
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        content = f.read()
+
+    return [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+def mock_details(appid):
+    return Mock(json=lambda: {
+        appid: {
+            'success': True,
+            'data': {
+                'name': 'Mock App',
+                'is_free': True
+            }
+        }
+    })
+
+
+class SteamAppTestCase(unittest.TestCase):
+    def setUp(self):
+        preview_cache.clear()
+
+    @patch('app.steam.REVIEWS_DEADLINE', 0.01)
+    def test_reviews_deadline(self):
+        # Store page never finishes loading
+        with patch('app.steam.fetch_async', return_value=resolved(mock_details('1'))), \
+             patch('app.steam.submit', return_value=Future()):
+            app = steam.SteamApp('1')
+
+            self.assertEqual(app.name, 'Mock App')
+            self.assertEqual(app.price, 'Free')
+            self.assertIsNone(app.reviews)
+
+    def test_details_deadline(self):
+        store = Future()
+
+        # Neither request ever finishes
+        with patch('app.steam.fetch_async', return_value=Future()), \
+             patch('app.steam.submit', return_value=store) as submit, \
+             deadline.deadline(0.05):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                steam.SteamApp('3').load_from_api()
+
+        # The store page load is told to give up
+        self.assertTrue(store.cancelled())
+        self.assertTrue(submit.call_args[0][2].is_set())
+
+    def test_invalid_app(self):
+        details = Mock(json=lambda: {'2': {'success': False}})
+
+        with patch('app.steam.fetch_async', return_value=resolved(details)), \
+             patch('app.steam.submit', return_value=Future()):
+            with self.assertRaises(steam.SteamApiException):
+                steam.SteamApp('2').load_from_api()
+
+
+class ScrapeTestCase(unittest.TestCase):
+    def test_scrape_reviews(self):
+        reviews = steam.scrape_reviews(load_fixture('steam_store.html'))
+
+        self.assertEqual(reviews, [
+            {'type': 'Recent Reviews', 'summary': 'Very Positive', 'count': '12,345'},
+            {'type': 'All Reviews', 'summary': 'Very Positive', 'count': '987,654'}
+        ])
+
+    def test_scrape_reviews_stops_early(self):
+        chunks = iter(load_fixture('steam_store.html'))
+        steam.scrape_reviews(chunks)
+
+        # The rest of the page is never read
+        self.assertTrue(list(chunks))
+
+    def test_scrape_workshop_item(self):
+        item = steam.scrape_workshop_item(load_fixture('steam_workshop.html'))
+
+        self.assertEqual(item['appname'], 'Garry\'s Mod')
+        self.assertEqual(item['title'], 'gm_construct_remastered')
+        self.assertEqual(item['logo'], 'https://steamuserimages-a.akamaihd.net/ugc/1234567890/ABCDEF/')
+        self.assertEqual(item['tags'], [['Type', 'Map'], ['Map Type', 'Build, Roleplay']])
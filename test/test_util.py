@@ -0,0 +1,38 @@
+import os
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+from app.util import image_to_data_uri, strip_suffix, url_around
+
+def encode_image(image, format):
+    buffered = BytesIO()
+    image.save(buffered, format=format)
+    return buffered.getvalue()
+
+
+class UtilTestCase(unittest.TestCase):
+    def test_small_image_passthrough(self):
+        content = encode_image(Image.new('RGB', (32, 32), (255, 0, 0)), 'PNG')
+        uri = image_to_data_uri(content, 4096)
+
+        self.assertTrue(uri.startswith('data:image/png;base64,'))
+
+    def test_large_image_fits_budget(self):
+        # Random noise compresses terribly, forcing both quality and size cuts
+        image = Image.frombytes('RGB', (1280, 720), os.urandom(1280 * 720 * 3))
+        uri = image_to_data_uri(encode_image(image, 'PNG'), 16 * 1024)
+
+        self.assertTrue(uri.startswith('data:image/jpeg;base64,'))
+        self.assertLessEqual(len(uri), 16 * 1024)
+
+    def test_not_an_image(self):
+        self.assertIsNone(image_to_data_uri(b'<html>Not Found</html>', 4096))
+
+    def test_url_around(self):
+        text = '<a href="https://youtu.be/abc?t=5">https://youtu.be/abc?t=5</a>'
+        start = text.index('youtu.be')
+
+        self.assertEqual(url_around(text, start, start + 8), 'https://youtu.be/abc?t=5')
+        self.assertEqual(strip_suffix('Video - YouTube', ' - YouTube'), 'Video')